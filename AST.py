@@ -1,22 +1,89 @@
+import re
+
+
 class Node:
-    pass
+    __slots__ = ()
+    kind = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # NumberExpression -> number_expression, names the handler methods of tree walkers
+        cls.kind = re.sub('([A-Z]+)', r'_\1', cls.__name__).lower().lstrip('_')
+
+
+def dispatch_table(walker, prefix):
+    """
+    Maps every node class to the method of walker named prefix + kind
+    (e.g. generate_number_expression), skipping classes it has no method for.
+    """
+    table = {}
+    classes = [Node]
+    while classes:
+        cls = classes.pop()
+        method = getattr(walker, prefix + cls.kind, None) if cls.kind else None
+        if method is not None:
+            table[cls] = method
+        classes.extend(cls.__subclasses__())
+    return table
+
+
+def children(node):
+    """
+    Yields the nodes directly under node.
+    """
+    for name in node.__slots__:
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            yield value
+        elif isinstance(value, list):
+            # call arguments, or the (name, initializer) pairs of a 'var'
+            for item in value:
+                if isinstance(item, tuple):
+                    item = item[1]
+                if isinstance(item, Node):
+                    yield item
+
+
+def walk(node):
+    """
+    Yields node and every node under it, without recursion.
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(children(node))
 
 
 class ExpressionNode(Node):
-    pass
+    __slots__ = ()
 
 
 class NumberExpression(ExpressionNode):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
 
 class VariableExpression(ExpressionNode):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
 
+class UnaryOperatorExpression(ExpressionNode):
+    __slots__ = ('operator', 'operand')
+
+    def __init__(self, operator, operand):
+        self.operator = operator
+        self.operand = operand
+
+
 class BinaryOperatorExpression(ExpressionNode):
+    __slots__ = ('operator', 'left', 'right')
+
     def __init__(self, operator, left, right):
         self.operator = operator
         self.left = left
@@ -24,12 +91,16 @@ class BinaryOperatorExpression(ExpressionNode):
 
 
 class FunctionCallExpression(ExpressionNode):
+    __slots__ = ('function', 'arguments')
+
     def __init__(self, function, arguments):
         self.function = function
         self.arguments = arguments
 
 
 class IfExpression(ExpressionNode):
+    __slots__ = ('condition', 'then_branch', 'else_branch')
+
     def __init__(self, condition, then_branch, else_branch):
         self.condition = condition
         self.then_branch = then_branch
@@ -37,6 +108,8 @@ class IfExpression(ExpressionNode):
 
 
 class ForExpression(ExpressionNode):
+    __slots__ = ('variable', 'start', 'end', 'step', 'body')
+
     def __init__(self, variable, start, end, step, body):
         self.variable = variable
         self.start = start
@@ -45,16 +118,29 @@ class ForExpression(ExpressionNode):
         self.body = body
 
 
+class VarExpression(ExpressionNode):
+    __slots__ = ('variables', 'body')
+
+    def __init__(self, variables, body):
+        self.variables = variables  # list of (name, initializer or None)
+        self.body = body
+
+
 class PrototypeNode(Node):
+    __slots__ = ('name', 'arguments')
+
     def __init__(self, name, arguments):
         self.name = name
         self.arguments = arguments
 
 
 class FunctionNode(Node):
-    def __init__(self, prototype, body):
+    __slots__ = ('prototype', 'body', 'memoize')
+
+    def __init__(self, prototype, body, memoize=False):
         self.prototype = prototype
         self.body = body
+        self.memoize = memoize
 
     _anonymous_counter = 0
 
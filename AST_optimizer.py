@@ -0,0 +1,120 @@
+import math
+from operator import lt, gt, le, ge, ne
+
+from AST import NumberExpression, BinaryOperatorExpression, UnaryOperatorExpression, FunctionCallExpression, \
+    IfExpression, ForExpression, VarExpression, FunctionNode, dispatch_table
+
+
+COMPARISONS = {
+    '<': lt,
+    '>': gt,
+    '<=': le,
+    '>=': ge,
+    '!=': ne,
+}
+
+
+class ASTOptimizer:
+    """
+    Simplifies expressions before code generation: folds operators on constants, removes
+    identities (x-0, x+(-0), x*1, x/1, 1*x) and replaces ifs on constant conditions by the
+    branch taken. Folding follows the semantics of the generated code, so results do not change;
+    x+0 is kept since -0 + 0 is +0.
+    """
+
+    def __init__(self):
+        self.stats = {'folded': 0, 'identities': 0, 'branches': 0}
+        self.handlers = dispatch_table(self, 'optimize_')
+
+    def optimize(self, node):
+        handler = self.handlers.get(node.__class__)
+        if handler is None:
+            return node
+        return handler(node)
+
+    def optimize_function_node(self, node):
+        return FunctionNode(node.prototype, self.optimize(node.body), node.memoize)
+
+    def optimize_binary_operator_expression(self, node):
+        # nested operators are simplified in post-order with an explicit stack rather than recursion
+        values = []
+        stack = [(node, False)]
+        while stack:
+            node, ready = stack.pop()
+            if ready:
+                right = values.pop()
+                left = values.pop()
+                values.append(self.simplify(node.operator, left, right))
+            elif isinstance(node, BinaryOperatorExpression):
+                stack.extend(((node, True), (node.right, False), (node.left, False)))
+            else:
+                values.append(self.optimize(node))
+        return values[0]
+
+    def simplify(self, operator, left, right):
+        left_constant = isinstance(left, NumberExpression)
+        right_constant = isinstance(right, NumberExpression)
+        if left_constant and right_constant:
+            value = self.fold(operator, left.value, right.value)
+            if value is not None:
+                self.stats['folded'] += 1
+                return NumberExpression(value)
+        if right_constant and (operator in '+-' and self.is_zero(right.value, operator == '+')
+                               or operator in '*/' and right.value == 1):
+            self.stats['identities'] += 1
+            return left
+        if left_constant and operator == '*' and left.value == 1:
+            self.stats['identities'] += 1
+            return right
+        return BinaryOperatorExpression(operator, left, right)
+
+    def is_zero(self, value, negative):
+        return value == 0 and (math.copysign(1.0, value) < 0) == negative
+
+    def fold(self, operator, left, right):
+        if operator == '+':
+            return left + right
+        elif operator == '-':
+            return left - right
+        elif operator == '*':
+            return left * right
+        elif operator == '/':
+            # division by zero is left to the generated code (inf or nan)
+            return left / right if right != 0 else None
+        elif operator in ('<', '>', '<=', '>=', '!='):
+            # the generated comparisons are unordered, i.e. true when either side is nan
+            if math.isnan(left) or math.isnan(right):
+                return 1.0
+            return float(COMPARISONS[operator](left, right))
+        elif operator == '==':
+            return float(left == right)
+        # '&' and '|' are not folded, since they may be user defined
+        return None
+
+    def truth(self, value):
+        return value != 0 and not math.isnan(value)
+
+    def optimize_unary_operator_expression(self, node):
+        return UnaryOperatorExpression(node.operator, self.optimize(node.operand))
+
+    def optimize_function_call_expression(self, node):
+        return FunctionCallExpression(node.function, [self.optimize(argument) for argument in node.arguments])
+
+    def optimize_if_expression(self, node):
+        condition = self.optimize(node.condition)
+        if isinstance(condition, NumberExpression):
+            self.stats['branches'] += 1
+            # the generated condition is an ordered comparison with 0.0, false for nan
+            taken = self.truth(condition.value)
+            return self.optimize(node.then_branch if taken else node.else_branch)
+        return IfExpression(condition, self.optimize(node.then_branch), self.optimize(node.else_branch))
+
+    def optimize_for_expression(self, node):
+        step = None if node.step is None else self.optimize(node.step)
+        return ForExpression(node.variable, self.optimize(node.start), self.optimize(node.end),
+                             step, self.optimize(node.body))
+
+    def optimize_var_expression(self, node):
+        variables = [(name, None if initializer is None else self.optimize(initializer))
+                     for name, initializer in node.variables]
+        return VarExpression(variables, self.optimize(node.body))
@@ -1,8 +1,11 @@
-import re
-
 import llvmlite.ir as ir
 
-from AST import FunctionNode, PrototypeNode
+from AST import FunctionNode, PrototypeNode, BinaryOperatorExpression, VariableExpression, IfExpression, \
+    FunctionCallExpression, dispatch_table
+from purity import PurityAnalysis
+
+# a memoized function caches its results in a table of 2 ** MEMO_TABLE_BITS entries
+MEMO_TABLE_BITS = 12
 
 
 class LLVMError(Exception):
@@ -10,29 +13,104 @@ class LLVMError(Exception):
 
 
 class LLVMGenerator:
-    def __init__(self):
+    def __init__(self, profile=False):
         self.module = ir.Module()
         self.builder = None
         self.symbol_table = {}
+        # count the calls and cycles spent in every defined function, see generate_profile_entry
+        self.profile = profile
+        self.profile_start = None
+        self.functions = {}
+        self.purity = PurityAnalysis()
+        # extern name -> (LLVM intrinsic, arguments count), for externs implemented by an intrinsic
+        self.intrinsics = {}
+        self.handlers = dispatch_table(self, 'generate_')
+
+    def new_module(self):
+        self.module = ir.Module()
+        return self.module
+
+    def get_function(self, name):
+        function = self.module.globals.get(name, None)
+        if function is None and name in self.functions:
+            known = self.functions[name]
+            # an extern implemented by an intrinsic is known under the name of the intrinsic
+            function = self.module.globals.get(known.name, None)
+            if function is None:
+                function = ir.Function(self.module, known.ftype, known.name)
+                self.add_attributes(function, known.attributes)
+        return function
+
+    def add_attributes(self, function, attributes):
+        for attribute in attributes:
+            # llvmlite.ir rejects the attributes it does not know of, such as willreturn
+            set.add(function.attributes, attribute)
 
     def generate_llvm(self, node):
         assert isinstance(node, (PrototypeNode, FunctionNode))
         return self.generate(node)
 
     def generate(self, node):
-        method = 'generate' + re.sub('([A-Z]+)', r'_\1', node.__class__.__name__).lower()
-        return getattr(self, method)(node)
+        handler = self.handlers.get(node.__class__)
+        if handler is None:
+            raise LLVMError("Unknown node type " + node.__class__.__name__)
+        return handler(node)
 
     def generate_number_expression(self, node):
         return ir.Constant(ir.DoubleType(), node.value)
 
     def generate_variable_expression(self, node):
-        return self.symbol_table[node.name]
+        variable = self.symbol_table.get(node.name)
+        if variable is None:
+            raise LLVMError("Unknown variable name " + str(node.name))
+        return self.builder.load(variable, node.name)
+
+    def create_entry_block_alloca(self, name):
+        # variables live in stack slots allocated in the entry block, where mem2reg promotes them to registers
+        entry = self.builder.function.entry_basic_block
+        builder = ir.IRBuilder(entry)
+        builder.position_at_start(entry)
+        variable = builder.alloca(ir.DoubleType(), name=name)
+        if self.builder.block is entry:
+            # code is only ever appended, so the builder moves past the new instruction
+            self.builder.position_at_end(entry)
+        return variable
+
+    def generate_var_expression(self, node):
+        old_bindings = []
+        for name, initializer in node.variables:
+            # the initializer is generated before the binding, so 'var a = a in' refers to the outer a
+            if initializer is None:
+                value = ir.Constant(ir.DoubleType(), 0.0)
+            else:
+                value = self.as_double(self.generate(initializer))
+            variable = self.create_entry_block_alloca(name)
+            self.builder.store(value, variable)
+            old_bindings.append((name, self.symbol_table.get(name)))
+            self.symbol_table[name] = variable
+
+        body = self.generate(node.body)
+
+        for name, old_value in reversed(old_bindings):
+            if old_value is None:
+                del self.symbol_table[name]
+            else:
+                self.symbol_table[name] = old_value
+        return body
+
+    def as_double(self, value):
+        # comparisons and logical operators produce i1 booleans, converted only where a number is needed
+        if value.type == ir.IntType(1):
+            return self.builder.uitofp(value, ir.DoubleType(), 'booltmp')
+        return value
+
+    def as_condition(self, value, name=''):
+        if value.type == ir.IntType(1):
+            return value
+        return self.builder.fcmp_ordered('!=', value, ir.Constant(ir.DoubleType(), 0.0), name)
 
     def generate_if_expression(self, node):
-        conditional = self.generate(node.condition)
-        cmp = self.builder.fcmp_ordered(
-            '!=', conditional, ir.Constant(ir.DoubleType(), 0.0))
+        cmp = self.as_condition(self.generate(node.condition))
 
         # conditional branch to either then_bb or else_bb depending on cmp
         then_bb = self.builder.function.append_basic_block('then')
@@ -41,15 +119,16 @@ class LLVMGenerator:
         self.builder.cbranch(cmp, then_bb, else_bb)
 
         self.builder.position_at_start(then_bb)
-        then_branch = self.generate(node.then_branch)
+        then_branch = self.as_double(self.generate(node.then_branch))
         self.builder.branch(merge_bb)
 
         then_bb = self.builder.block
         self.builder.function.basic_blocks.append(else_bb)
 
         self.builder.position_at_start(else_bb)
-        else_branch = self.generate(node.else_branch)
+        else_branch = self.as_double(self.generate(node.else_branch))
         self.builder.branch(merge_bb)
+        else_bb = self.builder.block
 
         self.builder.function.basic_blocks.append(merge_bb)
         self.builder.position_at_start(merge_bb)
@@ -59,18 +138,16 @@ class LLVMGenerator:
         return phi
 
     def generate_for_expression(self, node):
-        start = self.generate(node.start)
-        preheader_bb = self.builder.block
+        variable = self.create_entry_block_alloca(node.variable)
+        start = self.as_double(self.generate(node.start))
+        self.builder.store(start, variable)
         loop_bb = self.builder.function.append_basic_block('loop')
 
         self.builder.branch(loop_bb)
         self.builder.position_at_start(loop_bb)
 
-        phi = self.builder.phi(ir.DoubleType(), node.variable)
-        phi.add_incoming(start, preheader_bb)
-
         oldval = self.symbol_table.get(node.variable)
-        self.symbol_table[node.variable] = phi
+        self.symbol_table[node.variable] = variable
 
         # this value will be ignored
         body = self.generate(node.body)
@@ -78,20 +155,18 @@ class LLVMGenerator:
         if node.step is None:
             step = ir.Constant(ir.DoubleType(), 1.0)
         else:
-            step = self.generate(node.step)
-        next_var = self.builder.fadd(phi, step, 'nextvar')
+            step = self.as_double(self.generate(node.step))
+
+        cmp = self.as_condition(self.generate(node.end), 'loopcond')
 
-        end = self.generate(node.end)
-        cmp = self.builder.fcmp_ordered(
-            '!=', end, ir.Constant(ir.DoubleType(), 0.0),
-            'loopcond')
+        # the body may have assigned to the loop variable, so it is reloaded before the increment
+        current = self.builder.load(variable, node.variable)
+        self.builder.store(self.builder.fadd(current, step, 'nextvar'), variable)
 
-        loop_end_bb = self.builder.block
         after_bb = self.builder.function.append_basic_block('afterloop')
 
         self.builder.cbranch(cmp, loop_bb, after_bb)
         self.builder.position_at_start(after_bb)
-        phi.add_incoming(next_var, loop_end_bb)
 
         if oldval is None:
             del self.symbol_table[node.variable]
@@ -102,60 +177,358 @@ class LLVMGenerator:
         return ir.Constant(ir.DoubleType(), 0.0)
 
     def generate_binary_operator_expression(self, node):
-        left = self.generate(node.left)
-        right = self.generate(node.right)
-
-        if node.operator == '+':
+        # nested operators are generated in post-order with an explicit stack rather than recursion;
+        # the short-circuiting '&' and '|' go through three states: before, between and after their operands,
+        # an assignment '=' generates only its right operand
+        values = []
+        stack = [(node, 0, None)]
+        while stack:
+            node, state, blocks = stack.pop()
+            if not isinstance(node, BinaryOperatorExpression):
+                values.append(self.generate(node))
+            elif node.operator == '=':
+                if state == 0:
+                    if not isinstance(node.left, VariableExpression):
+                        raise LLVMError("Destination of '=' must be a variable")
+                    stack.append((node, 1, None))
+                    stack.append((node.right, 0, None))
+                else:
+                    value = self.as_double(values.pop())
+                    variable = self.symbol_table.get(node.left.name)
+                    if variable is None:
+                        raise LLVMError("Unknown variable name " + str(node.left.name))
+                    self.builder.store(value, variable)
+                    values.append(value)
+            elif state == 0:
+                stack.append((node, 1, None))
+                if not self.is_logical_operator(node.operator):
+                    stack.append((node.right, 0, None))
+                stack.append((node.left, 0, None))
+            elif not self.is_logical_operator(node.operator):
+                right = values.pop()
+                left = values.pop()
+                values.append(self.generate_binary_operator(node.operator, left, right))
+            elif state == 1:
+                left = self.as_condition(values.pop())
+                left_bb = self.builder.block
+                right_bb = self.builder.function.append_basic_block('logicrhs')
+                merge_bb = ir.Block(self.builder.function, 'logiccont')
+                if node.operator == '&':
+                    self.builder.cbranch(left, right_bb, merge_bb)
+                else:
+                    self.builder.cbranch(left, merge_bb, right_bb)
+                self.builder.position_at_start(right_bb)
+                stack.append((node, 2, (left_bb, merge_bb)))
+                stack.append((node.right, 0, None))
+            else:
+                right = self.as_condition(values.pop())
+                left_bb, merge_bb = blocks
+                right_bb = self.builder.block
+                self.builder.branch(merge_bb)
+                self.builder.function.basic_blocks.append(merge_bb)
+                self.builder.position_at_start(merge_bb)
+                phi = self.builder.phi(ir.IntType(1), 'logictmp')
+                phi.add_incoming(ir.Constant(ir.IntType(1), node.operator == '|'), left_bb)
+                phi.add_incoming(right, right_bb)
+                values.append(phi)
+        return values[0]
+
+    def is_logical_operator(self, operator):
+        # a user definition of '&' or '|' takes precedence over the builtin
+        return operator in ('&', '|') and 'binary' + operator not in self.functions
+
+    def generate_binary_operator(self, operator, left, right):
+        left = self.as_double(left)
+        right = self.as_double(right)
+        if operator == '+':
             return self.builder.fadd(left, right, 'addtmp')
-        elif node.operator == '-':
+        elif operator == '-':
             return self.builder.fsub(left, right, 'subtmp')
-        elif node.operator == '*':
+        elif operator == '*':
             return self.builder.fmul(left, right, 'multmp')
-        elif node.operator == '/':
+        elif operator == '/':
             return self.builder.fdiv(left, right, 'divtmp')
-        elif node.operator == '>':
-            cmp = self.builder.fcmp_unordered('>', left, right, 'cmptmp')
-            return self.builder.uitofp(cmp, ir.DoubleType(), 'booltmp')
-        elif node.operator == '<':
-            cmp = self.builder.fcmp_unordered('<', left, right, 'cmptmp')
-            return self.builder.uitofp(cmp, ir.DoubleType(), 'booltmp')
+        elif operator in ('<', '>', '<=', '>=', '!='):
+            # unordered: true when either side is nan
+            return self.builder.fcmp_unordered(operator, left, right, 'cmptmp')
+        elif operator == '==':
+            return self.builder.fcmp_ordered(operator, left, right, 'cmptmp')
         else:
-            raise LLVMError("Unknown binary operator " + str(node.operator))
+            # user defined operator, e.g. 'def binary| 5 (a b)'
+            function = self.get_function('binary' + operator)
+            if not function or not isinstance(function, ir.Function):
+                raise LLVMError("Unknown binary operator " + str(operator))
+            return self.builder.call(function, [left, right], 'binop', tail=True)
+
+    def generate_unary_operator_expression(self, node):
+        operand = self.as_double(self.generate(node.operand))
+        function = self.get_function('unary' + node.operator)
+        if not function or not isinstance(function, ir.Function):
+            raise LLVMError("Unknown unary operator " + str(node.operator))
+        return self.builder.call(function, [operand], 'unop', tail=True)
 
-    def generate_function_call_expression(self, node):
-        function = self.module.globals.get(node.function, None)
+    def generate_function_call_expression(self, node, returned=False):
+        function = self.get_function(node.function)
         if not function or not isinstance(function, ir.Function):
             raise LLVMError("Call to unknown function " + str(node.function))
         if len(function.args) != len(node.arguments):
             raise LLVMError("Function call with incorrect arguments count " + str(node.function))
-        arguments = [self.generate(arg) for arg in node.arguments]
-        return self.builder.call(function, arguments, 'calltmp')
+        arguments = [self.as_double(self.generate(arg)) for arg in node.arguments]
+        # no pointer to the caller's stack is ever passed, so every call may be a tail call; a call returned
+        # directly to a function of the same type must reuse the caller's frame, even without optimizations
+        same_type = len(function.args) == len(self.builder.function.args)
+        # a profiled function has work to do after the call
+        same_type = same_type and function.name == node.function and self.profile_start is None
+        tail = 'musttail' if returned and same_type else 'tail'
+        return self.builder.call(function, arguments, 'calltmp', tail=tail)
 
     def generate_prototype_node(self, node):
+        self.purity.add_extern(node)
+        intrinsic = self.intrinsics.get(node.name)
+        if intrinsic is not None and intrinsic[1] == len(node.arguments):
+            return self.declare_intrinsic(node.name, intrinsic[0])
+        func = self.declare_function(node)
+        self.add_attributes(func, self.purity.attributes(node.name))
+        return func
+
+    def declare_intrinsic(self, name, intrinsic):
+        # calls go straight to the intrinsic, which the optimizer can fold, inline and vectorize
+        func = self.get_function(name)
+        if func is None:
+            arguments_count = self.intrinsics[name][1]
+            func_ty = ir.FunctionType(ir.DoubleType(), [ir.DoubleType()] * arguments_count)
+            func = self.module.declare_intrinsic(intrinsic, [ir.DoubleType()], func_ty)
+            self.functions[name] = func
+        return func
+
+    def declare_function(self, node):
         function = node.name
         func_ty = ir.FunctionType(ir.DoubleType(), [ir.DoubleType()] * len(node.arguments))
-        if function in self.module.globals:
-            existing_func = self.module.globals[function]
-            if not isinstance(existing_func, ir.Function):
+        existing_func = self.get_function(function)
+        if existing_func is not None:
+            if not isinstance(existing_func, ir.Function) or existing_func.name != function:
                 raise LLVMError("Function or global name collision " + str(function))
-            if not existing_func.is_declaration():
+            if not self.functions.get(function, existing_func).is_declaration:
                 raise LLVMError("Redefinition of function " + str(function))
             if len(existing_func.args) != len(func_ty.args):
                 raise LLVMError("Redefinition of function " +
                                 str(function) + " with different arguments count")
-            func = self.module.globals[function]
+            func = existing_func
         else:
             func = ir.Function(self.module, func_ty, function)
+        self.functions.setdefault(function, func)
         for i, arg in enumerate(func.args):
             arg.name = node.arguments[i]
-            self.symbol_table[arg.name] = arg
         return func
 
     def generate_function_node(self, node):
         self.symbol_table = {}
-        func = self.generate(node.prototype)
+        self.profile_start = None
+        declared = node.prototype.name in self.functions
+        func = self.declare_function(node.prototype)
         bb_entry = func.append_basic_block('entry')
         self.builder = ir.IRBuilder(bb_entry)
-        return_value = self.generate(node.body)
-        self.builder.ret(return_value)
+        try:
+            # arguments are copied to stack slots, so they can be assigned like any other variable
+            for arg in func.args:
+                variable = self.create_entry_block_alloca(arg.name)
+                self.builder.store(arg, variable)
+                self.symbol_table[arg.name] = variable
+            if self.profile and not node.is_anonymous():
+                self.profile_start = self.generate_profile_entry(func)
+            if node.memoize:
+                if not self.purity.memoizable(node):
+                    raise LLVMError("Memoized function " + str(node.prototype.name) + " calls impure functions")
+                memo = self.generate_memo_lookup(func)
+                return_value = self.as_double(self.generate(node.body))
+                self.generate_memo_store(memo, return_value)
+                self.generate_ret(return_value)
+            else:
+                self.generate_return(node.body)
+        except Exception:
+            # drop the partial body so the function can be defined again, and forget a function which was
+            # never declared before, since it will not be compiled
+            func.blocks = []
+            if not declared:
+                del self.functions[node.prototype.name]
+            raise
+        if not node.is_anonymous():
+            # anonymous functions are never called, so they are left out of the analysis to keep it from growing
+            self.purity.add_function(node)
+        # a definition replaces the attributes of an earlier extern
+        func.attributes.clear()
+        if not self.profile:
+            # profiled functions write their counters
+            self.add_attributes(func, self.purity.attributes(node.prototype.name))
+        self.functions[node.prototype.name] = func
         return func
+
+    def generate_ret(self, value):
+        if self.profile_start is not None:
+            self.generate_profile_exit()
+        self.builder.ret(value)
+
+    def profile_counter(self, name):
+        counter = self.module.globals.get(name)
+        if counter is None:
+            counter = ir.GlobalVariable(self.module, ir.IntType(64), name)
+            counter.initializer = ir.Constant(ir.IntType(64), 0)
+        return counter
+
+    def generate_profile_entry(self, func):
+        """
+        Counts the call in the global <name>.calls and returns the cycle counter at entry; every return
+        adds the cycles elapsed to <name>.cycles, including those spent in callees.
+        """
+        i64 = ir.IntType(64)
+        self.builder.atomic_rmw('add', self.profile_counter(func.name + '.calls'), ir.Constant(i64, 1), 'monotonic')
+        read_cycles = self.module.declare_intrinsic('llvm.readcyclecounter', fnty=ir.FunctionType(i64, []))
+        return self.builder.call(read_cycles, [], 'start')
+
+    def generate_profile_exit(self):
+        i64 = ir.IntType(64)
+        read_cycles = self.module.declare_intrinsic('llvm.readcyclecounter', fnty=ir.FunctionType(i64, []))
+        cycles = self.builder.sub(self.builder.call(read_cycles, [], 'end'), self.profile_start)
+        name = self.builder.function.name + '.cycles'
+        self.builder.atomic_rmw('add', self.profile_counter(name), cycles, 'monotonic')
+
+    def generate_return(self, node):
+        # the branches of an if in tail position return on their own, so calls in tail position are followed
+        # directly by a ret and recursion through them runs in constant stack space
+        if isinstance(node, IfExpression):
+            cmp = self.as_condition(self.generate(node.condition))
+            then_bb = self.builder.function.append_basic_block('then')
+            else_bb = ir.Block(self.builder.function, 'else')
+            self.builder.cbranch(cmp, then_bb, else_bb)
+
+            self.builder.position_at_start(then_bb)
+            self.generate_return(node.then_branch)
+
+            self.builder.function.basic_blocks.append(else_bb)
+            self.builder.position_at_start(else_bb)
+            self.generate_return(node.else_branch)
+        elif isinstance(node, FunctionCallExpression):
+            self.generate_ret(self.generate_function_call_expression(node, returned=True))
+        else:
+            self.generate_ret(self.as_double(self.generate(node)))
+
+    def generate_memo_lookup(self, func):
+        """
+        Looks the arguments up in the function's table of results, returning the cached result on a hit.
+        Each entry is guarded by a sequence number (a seqlock): odd while the entry is being written and
+        zero while it is empty, so threads calling the function concurrently never see a torn entry.
+        """
+        i64 = ir.IntType(64)
+        entry_type = ir.LiteralStructType([i64, i64, ir.ArrayType(i64, len(func.args))])
+        table_type = ir.ArrayType(entry_type, 1 << MEMO_TABLE_BITS)
+        table = self.module.globals.get(func.name + '.memo')
+        if table is None:
+            table = ir.GlobalVariable(self.module, table_type, func.name + '.memo')
+            table.linkage = 'internal'
+            table.initializer = ir.Constant(table_type, None)
+
+        # the arguments are compared by their bits, so nan arguments are cached as well
+        keys = [self.builder.bitcast(arg, i64) for arg in func.args]
+        hash_value = ir.Constant(i64, 0)
+        for key in keys:
+            hash_value = self.builder.mul(self.builder.xor(hash_value, key), ir.Constant(i64, 0x9E3779B97F4A7C15))
+        index = self.builder.lshr(hash_value, ir.Constant(i64, 64 - MEMO_TABLE_BITS))
+
+        zero = ir.Constant(ir.IntType(32), 0)
+        entry = self.builder.gep(table, [zero, index], inbounds=True)
+        sequence_ptr = self.builder.gep(entry, [zero, zero], inbounds=True)
+        result_ptr = self.builder.gep(entry, [zero, ir.Constant(ir.IntType(32), 1)], inbounds=True)
+        key_ptrs = [self.builder.gep(entry, [zero, ir.Constant(ir.IntType(32), 2), ir.Constant(ir.IntType(32), i)],
+                                     inbounds=True) for i in range(len(keys))]
+
+        check_bb = self.builder.function.append_basic_block('memocheck')
+        hit_bb = self.builder.function.append_basic_block('memohit')
+        miss_bb = self.builder.function.append_basic_block('memomiss')
+
+        sequence = self.builder.load_atomic(sequence_ptr, 'acquire', 8)
+        complete = self.builder.and_(
+            self.builder.icmp_unsigned('==', self.builder.and_(sequence, ir.Constant(i64, 1)), ir.Constant(i64, 0)),
+            self.builder.icmp_unsigned('!=', sequence, ir.Constant(i64, 0)))
+        self.builder.cbranch(complete, check_bb, miss_bb)
+
+        self.builder.position_at_start(check_bb)
+        hit = ir.Constant(ir.IntType(1), 1)
+        for key, key_ptr in zip(keys, key_ptrs):
+            cached_key = self.builder.load_atomic(key_ptr, 'monotonic', 8)
+            hit = self.builder.and_(hit, self.builder.icmp_unsigned('==', cached_key, key))
+        result = self.builder.load_atomic(result_ptr, 'monotonic', 8)
+        self.builder.fence('acquire')
+        unchanged = self.builder.icmp_unsigned('==', self.builder.load_atomic(sequence_ptr, 'monotonic', 8), sequence)
+        self.builder.cbranch(self.builder.and_(hit, unchanged), hit_bb, miss_bb)
+
+        self.builder.position_at_start(hit_bb)
+        self.generate_ret(self.builder.bitcast(result, ir.DoubleType()))
+
+        self.builder.position_at_start(miss_bb)
+        return keys, sequence_ptr, result_ptr, key_ptrs
+
+    def generate_memo_store(self, memo, value):
+        # an entry being written by another thread is left alone
+        keys, sequence_ptr, result_ptr, key_ptrs = memo
+        i64 = ir.IntType(64)
+        lock_bb = self.builder.function.append_basic_block('memolock')
+        store_bb = self.builder.function.append_basic_block('memostore')
+        done_bb = self.builder.function.append_basic_block('memodone')
+
+        sequence = self.builder.load_atomic(sequence_ptr, 'monotonic', 8)
+        unlocked = self.builder.icmp_unsigned('==', self.builder.and_(sequence, ir.Constant(i64, 1)),
+                                              ir.Constant(i64, 0))
+        self.builder.cbranch(unlocked, lock_bb, done_bb)
+
+        self.builder.position_at_start(lock_bb)
+        locked = self.builder.cmpxchg(sequence_ptr, sequence, self.builder.add(sequence, ir.Constant(i64, 1)),
+                                      'monotonic', 'monotonic')
+        self.builder.cbranch(self.builder.extract_value(locked, 1), store_bb, done_bb)
+
+        self.builder.position_at_start(store_bb)
+        self.builder.fence('release')
+        for key, key_ptr in zip(keys, key_ptrs):
+            self.builder.store_atomic(key, key_ptr, 'monotonic', 8)
+        self.builder.store_atomic(self.builder.bitcast(value, i64), result_ptr, 'monotonic', 8)
+        self.builder.store_atomic(self.builder.add(sequence, ir.Constant(i64, 2)), sequence_ptr, 'release', 8)
+        self.builder.branch(done_bb)
+
+        self.builder.position_at_start(done_bb)
+
+    def generate_map_function(self, name):
+        """
+        Generates void <name>.map(double *output, double *input, ..., i64 count), calling the
+        function on the elements of the input arrays, one array per argument.
+        """
+        function = self.get_function(name)
+        if not function or not isinstance(function, ir.Function):
+            raise LLVMError("Call to unknown function " + str(name))
+
+        double_pointer = ir.DoubleType().as_pointer()
+        index_type = ir.IntType(64)
+        map_ty = ir.FunctionType(ir.VoidType(), [double_pointer] * (len(function.args) + 1) + [index_type])
+        map_function = ir.Function(self.module, map_ty, name + '.map')
+        output, inputs, count = map_function.args[0], map_function.args[1:-1], map_function.args[-1]
+        output.add_attribute('noalias')
+
+        bb_entry = map_function.append_basic_block('entry')
+        bb_loop = map_function.append_basic_block('loop')
+        bb_after = map_function.append_basic_block('afterloop')
+        builder = ir.IRBuilder(bb_entry)
+        empty = builder.icmp_signed('<=', count, ir.Constant(index_type, 0), 'empty')
+        builder.cbranch(empty, bb_after, bb_loop)
+
+        builder.position_at_start(bb_loop)
+        index = builder.phi(index_type, 'index')
+        index.add_incoming(ir.Constant(index_type, 0), bb_entry)
+        arguments = [builder.load(builder.gep(array, [index])) for array in inputs]
+        value = builder.call(function, arguments, 'calltmp')
+        builder.store(value, builder.gep(output, [index]))
+        next_index = builder.add(index, ir.Constant(index_type, 1), 'nextindex')
+        index.add_incoming(next_index, bb_loop)
+        loop_condition = builder.icmp_signed('<', next_index, count, 'loopcond')
+        builder.cbranch(loop_condition, bb_loop, bb_after)
+
+        builder.position_at_start(bb_after)
+        builder.ret_void()
+        return map_function
@@ -0,0 +1,286 @@
+"""
+Benchmarks of the compiler and of the code it generates.
+
+    python kaleidoscope_benchmark.py --output results.json
+    python kaleidoscope_benchmark.py --baseline results.json
+
+The first run records the results as JSON, the second compares a new run against them and exits with
+status 1 when a benchmark got slower than the threshold allows. The synthetic programs are generated
+from a fixed seed, so two runs at the same scale measure the same work.
+"""
+import contextlib
+import functools
+import gc
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import llvmlite
+import llvmlite.binding as llvm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from LLVM_code_generator import LLVMGenerator
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_lexer import Lexer
+from kaleidoscope_parser import Parser
+
+FIB = 'def fib(x) if x < 3 then 1 else fib(x - 1) + fib(x - 2)'
+
+KERNEL = '''
+    extern sqrt(x);
+    def kernel(n) var sum in (for i = 1, i < n in sum = sum + sqrt(i) * 0.5) + sum;
+'''
+
+WAVE = '''
+    extern sin(x);
+    extern cos(x);
+    extern sqrt(x);
+    def wave(x) sin(x) * cos(x) + sqrt(x);
+'''
+
+# threads of the apply benchmarks, the same on every machine so that results can be compared
+APPLY_THREADS = (1, 2, 4)
+
+
+def random_expression(rng, variables, functions, depth):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(variables) if rng.random() < 0.7 else str(rng.randint(0, 100))
+    choice = rng.random()
+    if choice < 0.6:
+        return '({0} {1} {2})'.format(random_expression(rng, variables, functions, depth - 1),
+                                      rng.choice('+-*<'),
+                                      random_expression(rng, variables, functions, depth - 1))
+    if choice < 0.8 and functions:
+        name = rng.choice(functions)
+        return '{0}({1}, {2})'.format(name, random_expression(rng, variables, functions, depth - 1),
+                                      random_expression(rng, variables, functions, depth - 1))
+    return 'if {0} then {1} else {2}'.format(random_expression(rng, variables, functions, depth - 1),
+                                             random_expression(rng, variables, functions, depth - 1),
+                                             random_expression(rng, variables, functions, depth - 1))
+
+
+def synthetic_program(definitions, seed=0):
+    """
+    Returns a program of definitions functions of two arguments, each calling some of the earlier ones.
+    """
+    rng = random.Random(seed)
+    functions = []
+    lines = []
+    for i in range(definitions):
+        name = 'f{0}'.format(i)
+        lines.append('def {0}(x y) {1};'.format(name, random_expression(rng, ['x', 'y'], functions[-20:], 4)))
+        functions.append(name)
+    return '\n'.join(lines)
+
+
+def deep_expression(depth):
+    # a right leaning chain of alternating operators nested in parentheses
+    return ''.join('{0} {1} ('.format(i % 10, '+*'[i % 2]) for i in range(depth)) + 'x' + ')' * depth
+
+
+def sized(base, scale):
+    return max(1, int(base * scale))
+
+
+def bench_lex(scale):
+    text = synthetic_program(sized(2000, scale))
+    lexer = Lexer()
+    return lambda: sum(1 for _ in lexer.tokenize(text))
+
+
+def bench_parse_definitions(scale):
+    text = synthetic_program(sized(2000, scale))
+    return lambda: list(Parser().parse_program(text))
+
+
+def bench_parse_deep_expression(scale):
+    text = 'def deep(x) ' + deep_expression(sized(20000, scale))
+    return lambda: Parser().parse(text)
+
+
+def bench_codegen_definitions(scale):
+    asts = list(Parser().parse_program(synthetic_program(sized(2000, scale))))
+
+    def run():
+        generator = LLVMGenerator()
+        for ast in asts:
+            generator.generate_llvm(ast)
+    return run
+
+
+def bench_codegen_deep_expression(scale):
+    ast = Parser().parse('def deep(x) ' + deep_expression(sized(20000, scale)))
+    return lambda: LLVMGenerator().generate_llvm(ast)
+
+
+def bench_jit_program(scale):
+    # a fresh session each time, since functions cannot be defined twice
+    text = synthetic_program(sized(300, scale))
+    return lambda: Evaluator().evaluate_program(text + '\nf0(1, 2);')
+
+
+def bench_fib(scale):
+    evaluator = Evaluator()
+    evaluator.evaluate(FIB)
+    expression = 'fib({0})'.format(20 + sized(10, scale))
+    return lambda: evaluator.evaluate(expression)
+
+
+def bench_loop_kernel(scale):
+    evaluator = Evaluator()
+    evaluator.evaluate_program(KERNEL)
+    expression = 'kernel({0})'.format(sized(5000000, scale))
+    return lambda: evaluator.evaluate(expression)
+
+
+def bench_repeated_evaluate(scale):
+    # a session alternating between a few expressions, each compiled once and then served from the cache
+    evaluator = Evaluator()
+    evaluator.evaluate('def sq(x) x * x')
+    expressions = ['sq({0}) + {0}'.format(i) for i in range(10)]
+    count = sized(1000, scale)
+    return lambda: [evaluator.evaluate(expressions[i % len(expressions)]) for i in range(count)]
+
+
+def bench_apply(scale, threads):
+    # the speedup over apply_threads_1 shows how Evaluator.apply scales over the cores
+    evaluator = Evaluator()
+    evaluator.evaluate_program(WAVE)
+    array = numpy.linspace(0, 1000, sized(2000000, scale))
+    return lambda: evaluator.apply('wave', array, threads=threads)
+
+
+BENCHMARKS = {
+    'lex': bench_lex,
+    'parse_definitions': bench_parse_definitions,
+    'parse_deep_expression': bench_parse_deep_expression,
+    'codegen_definitions': bench_codegen_definitions,
+    'codegen_deep_expression': bench_codegen_deep_expression,
+    'jit_program': bench_jit_program,
+    'fib': bench_fib,
+    'loop_kernel': bench_loop_kernel,
+    'repeated_evaluate': bench_repeated_evaluate,
+}
+if numpy is not None:
+    for threads in APPLY_THREADS:
+        BENCHMARKS['apply_threads_{0}'.format(threads)] = functools.partial(bench_apply, threads=threads)
+
+
+def measure(run, repeat):
+    """
+    Times repeat runs after a warm-up one, then measures the peak of Python memory of one more run.
+    """
+    run()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeat': repeat,
+        'peak_memory': peak_memory,
+    }
+
+
+def run_benchmarks(names=None, scale=1.0, repeat=5):
+    llvm.initialize()
+    llvm.initialize_native_target()
+    llvm.initialize_native_asmprinter()
+
+    results = {}
+    # the parser reports every item it parses
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in names or BENCHMARKS:
+            results[name] = measure(BENCHMARKS[name](scale), repeat)
+    return {
+        'metadata': {
+            'scale': scale,
+            'python': platform.python_version(),
+            'llvmlite': llvmlite.__version__,
+            'llvm': '.'.join(map(str, llvm.llvm_version_info)),
+            'cpu': llvm.get_host_cpu_name(),
+            'platform': platform.platform(),
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Returns {name: median time relative to the baseline} for the benchmarks present in both, and the names
+    of those slower than 1 + threshold times the baseline.
+    """
+    ratios = {}
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        ratios[name] = result['median'] / before['median']
+        if ratios[name] > 1 + threshold:
+            regressions.append(name)
+    return ratios, regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the Kaleidoscope compiler.')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, all by default: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the workloads (default 1)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of every benchmark (default 5)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file instead of stdout')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression when comparing (default 0.1, i.e. 10%%)')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+
+    results = run_benchmarks(args.benchmarks, args.scale, args.repeat)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    elif not args.baseline:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['metadata'].get('scale') != args.scale:
+            print('warning: the baseline was run at scale {0}'.format(baseline['metadata'].get('scale')),
+                  file=sys.stderr)
+        ratios, regressions = compare(results, baseline, args.threshold)
+        for name, ratio in ratios.items():
+            print('{0:<26}{1:>12.6f} s{2:>8.2f}x{3}'.format(
+                name, results['benchmarks'][name]['median'], ratio,
+                '  REGRESSION' if name in regressions else ''))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
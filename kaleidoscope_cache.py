@@ -0,0 +1,63 @@
+import hashlib
+import os
+import tempfile
+
+
+class ObjectCache:
+    """
+    On-disk cache of compiled object code, addressed by a hash of everything the code depends on.
+    Least recently used entries are evicted once the total size goes over max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.o')
+
+    def load(self, key):
+        # the entry may be evicted by another process at any time, so only reading it makes a hit
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path)  # mark as recently used
+        return data
+
+    def store(self, key, data):
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.o'):
+                status = os.stat(os.path.join(self.directory, name))
+                entries.append((status.st_mtime, status.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, name = entries.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -1,25 +1,103 @@
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import CFUNCTYPE, c_double, c_int64, c_void_p
+
 import llvmlite.binding as llvm
-from ctypes import CFUNCTYPE, c_double
 
-from AST import FunctionNode
-from LLVM_code_generator import LLVMGenerator
+from AST import FunctionNode, PrototypeNode, walk
+from AST_optimizer import ASTOptimizer
+from LLVM_code_generator import LLVMGenerator, LLVMError
+from kaleidoscope_optimizer import Optimizer
 from kaleidoscope_parser import Parser
+from kaleidoscope_stats import Stats, phase
+
+
+# externs implemented by LLVM intrinsics rather than calls to the C math library: name -> (intrinsic, arguments)
+MATH_INTRINSICS = {
+    'sqrt': ('llvm.sqrt', 1),
+    'fabs': ('llvm.fabs', 1),
+    'floor': ('llvm.floor', 1),
+    'ceil': ('llvm.ceil', 1),
+    'trunc': ('llvm.trunc', 1),
+    'round': ('llvm.round', 1),
+    'sin': ('llvm.sin', 1),
+    'cos': ('llvm.cos', 1),
+    'exp': ('llvm.exp', 1),
+    'exp2': ('llvm.exp2', 1),
+    'log': ('llvm.log', 1),
+    'log2': ('llvm.log2', 1),
+    'log10': ('llvm.log10', 1),
+    'pow': ('llvm.pow', 2),
+    'fma': ('llvm.fma', 3),
+}
+
+# anonymous functions are numbered over the whole process, see _compile
+ANONYMOUS_FUNCTION = re.compile(r'@"(anonymous_\d+)"')
 
 
 class Evaluator:
-    def __init__(self):
+    def __init__(self, cache=None, expressions_cache_size=128, optimizer=None,
+                 cpu='host', features='host', code_model=None, codegen_opt_level=2, simplify=True,
+                 stats=None, profile=False):
         llvm.initialize()
         llvm.initialize_native_target()
         llvm.initialize_native_asmprinter()
 
-        self.parser = Parser()
-        self.generator = LLVMGenerator()
-        self._add_builtins(self.generator.module)
+        # optional kaleidoscope_stats.Stats, timing the phases of the compiler
+        self.stats = stats
+        self.parser = Parser(stats)
+        # with profile, defined functions count their calls and cycles, see profile()
+        self.generator = LLVMGenerator(profile=profile)
+        self.optimizer = optimizer if optimizer is not None else Optimizer()
+        # AST level constant folding before code generation, None when disabled
+        self.ast_optimizer = ASTOptimizer() if simplify else None
+
+        # 'host' targets the CPU we are running on, '' the generic CPU of the triple
+        self.cpu = llvm.get_host_cpu_name() if cpu == 'host' else cpu
+        self.features = llvm.get_host_cpu_features().flatten() if features == 'host' else features
+        self.code_model = code_model
+        self.codegen_opt_level = codegen_opt_level
 
         self.target = llvm.Target.from_default_triple()
+        self.target_machine = self.target.create_target_machine(
+            cpu=self.cpu, features=self.features, opt=codegen_opt_level,
+            codemodel=code_model or 'jitdefault')
+        # files are emitted position independent so that objects can be linked into shared libraries;
+        # MCJIT itself does not handle PIC code reliably, hence the separate machine
+        self.object_target_machine = self.target.create_target_machine(
+            cpu=self.cpu, features=self.features, opt=codegen_opt_level,
+            codemodel=code_model or 'default', reloc='pic')
+        # one long-lived engine; every evaluated item is added to it as its own module
+        self.engine = llvm.create_mcjit_compiler(llvm.parse_assembly(''), self.target_machine)
+
+        # optional kaleidoscope_cache.ObjectCache; modules are named after their cache key
+        self.cache = cache
+        self._cache_key = None
+        self._cached_object = None
+        if cache is not None or stats is not None:
+            self.engine.set_object_cache(self._object_compiled, self._object_lookup)
+
+        # compiled top-level expressions by their flattened AST, least recently used first
+        self.expressions = OrderedDict()
+        self.expressions_cache_size = expressions_cache_size
+        self._expressions_by_function = {}
+        # compiled array wrappers by function name, see apply()
+        self.map_functions = {}
+        # typed callables by function name, see get_function()
+        self.compiled_functions = {}
 
-    def _add_builtins(self, module):
+        self._add_builtins(self.generator)
+        self._compile(self.generator.module, optimize=True)
+
+    def _add_builtins(self, generator):
         import llvmlite.ir as ir
+        module = generator.module
         # Add the declaration of putchar
         putchar_ty = ir.FunctionType(ir.IntType(32), [ir.IntType(32)])
         putchar = ir.Function(module, putchar_ty, 'putchar')
@@ -31,32 +109,365 @@ class Evaluator:
         ival = irbuilder.fptoui(putchard.args[0], ir.IntType(32), 'intcast')
         irbuilder.call(putchar, [ival])
         irbuilder.ret(ir.Constant(ir.DoubleType(), 0))
+        generator.functions[putchard.name] = putchard
+
+        # other externs are looked up in the process, e.g. in the C library
+        generator.intrinsics.update(MATH_INTRINSICS)
+
+    def _object_compiled(self, llvm_mod, data):
+        if self.stats is not None:
+            self.stats.count('object_bytes', len(data))
+        if self.cache is not None and llvm_mod.name == self._cache_key:
+            self.cache.store(self._cache_key, data)
+
+    def _object_lookup(self, llvm_mod):
+        if self.cache is not None and llvm_mod.name == self._cache_key:
+            return self._cached_object
+        return None
+
+    def _count_instructions(self, name, llvm_mod):
+        if self.stats is not None:
+            self.stats.count(name, sum(len(list(block.instructions))
+                                       for function in llvm_mod.functions for block in function.blocks))
+
+    def _optimize(self, module, optimize):
+        # module is an llvmlite.ir module or its text
+        with phase(self.stats, 'parse_assembly'):
+            llvm_mod = llvm.parse_assembly(str(module))
+            llvm_mod.triple = self.target_machine.triple
+            llvm_mod.data_layout = str(self.target_machine.target_data)
+
+        self._count_instructions('instructions_before', llvm_mod)
+        if optimize:
+            with phase(self.stats, 'optimize'):
+                self.optimizer.run(llvm_mod, self.target_machine)
+        self._count_instructions('instructions_after', llvm_mod)
+        return llvm_mod
+
+    def _compile(self, module, optimize):
+        """
+        Adds the module to the engine and returns it, along with {name: symbol} for its anonymous functions.
+        """
+        text = str(module)
+        names = list(OrderedDict.fromkeys(ANONYMOUS_FUNCTION.findall(text)))
+        symbols = {name: name for name in names}
+        self._cached_object = None
+        if self.cache is not None:
+            # the numbers of anonymous functions depend on what the process evaluated before, so they are
+            # left out of the key and the functions are compiled under names derived from the key instead
+            self._cache_key = self.cache.key(
+                self._rename(text, {name: 'anonymous.{0}'.format(i) for i, name in enumerate(names)}),
+                self.optimizer.key() if optimize else None,
+                self.target_machine.triple, self.cpu, self.features, self.code_model, self.codegen_opt_level)
+            symbols = {name: 'anonymous.{0}.{1}'.format(self._cache_key[:16], i) for i, name in enumerate(names)}
+            text = self._rename(text, symbols)
+            # on a hit the object code comes from the cache, so optimizing would be wasted work
+            self._cached_object = self.cache.load(self._cache_key)
+
+        llvm_mod = self._optimize(text, optimize and self._cached_object is None)
+        if self.cache is not None:
+            llvm_mod.name = self._cache_key
+        with phase(self.stats, 'finalize'):
+            self.engine.add_module(llvm_mod)
+            self.engine.finalize_object()
+        return llvm_mod, symbols
+
+    def _rename(self, text, names):
+        return ANONYMOUS_FUNCTION.sub(lambda match: '@"{0}"'.format(names[match.group(1)]), text)
+
+    def _simplify(self, ast):
+        if ast is not None and self.stats is not None:
+            self.stats.count('nodes', sum(1 for _ in walk(ast)))
+        if self.ast_optimizer is None or ast is None:
+            return ast
+        with phase(self.stats, 'simplify'):
+            return self.ast_optimizer.optimize(ast)
+
+    def _generate(self, generator, ast):
+        with phase(self.stats, 'codegen'):
+            generator.generate_llvm(ast)
+
+    def _execute(self, fptr):
+        with phase(self.stats, 'execute'):
+            return fptr()
+
+    def _invalidate(self, function):
+        self.compiled_functions.pop(function, None)
+        if function in self.map_functions:
+            self.engine.remove_module(self.map_functions.pop(function)[1])
+        for key in self._expressions_by_function.pop(function, ()):
+            if key in self.expressions:
+                self._forget_expression(key)
+
+    def _forget_expression(self, key):
+        fptr, llvm_mod = self.expressions.pop(key)
+        self.engine.remove_module(llvm_mod)
+
+    def _remember_expression(self, key, fptr, llvm_mod, functions):
+        self.expressions[key] = (fptr, llvm_mod)
+        for function in functions:
+            self._expressions_by_function.setdefault(function, set()).add(key)
+        while len(self.expressions) > self.expressions_cache_size:
+            self._forget_expression(next(iter(self.expressions)))
+
+    def _expression_key(self, flat):
+        """
+        Serializes a flattened expression into a flat tuple (each list prefixed by its length, numbers
+        by their bits since 0.0 == -0.0), without recursion, and collects the functions it calls.
+        """
+        items = []
+        functions = set()
+        stack = [flat]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, list):
+                # the [name, initializer] pairs of a 'var' never have a string second item
+                if len(item) > 1 and isinstance(item[1], str):
+                    if item[0] == 'Call':
+                        functions.add(item[1])
+                    elif item[0] == 'Binop':
+                        functions.add('binary' + item[1])
+                    elif item[0] == 'Unary':
+                        functions.add('unary' + item[1])
+                items.append((len(item),))
+                stack.extend(reversed(item))
+            elif isinstance(item, float):
+                items.append(struct.pack('<d', item))
+            else:
+                items.append(item)
+        return tuple(items), functions
 
     def evaluate(self, string, optimize=True):
-        ast = self.parser.parse(string)
-        self.generator.generate_llvm(ast)
-        if not (isinstance(ast, FunctionNode) and ast.is_anonymous()):
+        operators = self.parser.operators_precendence.save()
+        ast = self._simplify(self.parser.parse(string))
+        anonymous = isinstance(ast, FunctionNode) and ast.is_anonymous()
+        if anonymous:
+            key, functions = self._expression_key(self.parser._flatten(ast.body))
+            key = (optimize, key)
+            if key in self.expressions:
+                self.expressions.move_to_end(key)
+                return self._execute(self.expressions[key][0])
+
+        self.generator.new_module()
+        try:
+            self._generate(self.generator, ast)
+        except Exception:
+            # an operator is only defined once its definition succeeded
+            self.parser.operators_precendence.restore(operators)
+            raise
+        if isinstance(ast, PrototypeNode):
+            # externs are resolved by symbol when a module calling them is finalized
+            self._invalidate(ast.name)
             return None
 
-        # print("-------------- Generated -------------------")
-        # print(str(self.generator.module))
-        llvm_mod = llvm.parse_assembly(str(self.generator.module))
+        llvm_mod, symbols = self._compile(self.generator.module, optimize)
+        if not anonymous:
+            self._invalidate(ast.prototype.name)
+            return None
 
-        if optimize:
-            pmb = llvm.create_pass_manager_builder()
-            pmb.opt_level = 2
-            pm = llvm.create_module_pass_manager()
-            pmb.populate(pm)
-            pm.run(llvm_mod)
-            # print("-------------- Optimized -------------------")
-            # print(str(llvm_mod))
-
-        target_machine = self.target.create_target_machine()
-        with llvm.create_mcjit_compiler(llvm_mod, target_machine) as ee:
-            ee.finalize_object()
-
-            func = llvm_mod.get_function(ast.prototype.name)
-            fptr = CFUNCTYPE(c_double)(ee.get_pointer_to_function(func))
-
-            result = fptr()
-            return result
+        name = ast.prototype.name
+        fptr = CFUNCTYPE(c_double)(self.engine.get_function_address(symbols[name]))
+        del self.generator.functions[name]
+        if self.expressions_cache_size > 0:
+            self._remember_expression(key, fptr, llvm_mod, functions)
+            return self._execute(fptr)
+        try:
+            return self._execute(fptr)
+        finally:
+            # anonymous expressions run once, so their code is not kept around
+            self.engine.remove_module(llvm_mod)
+
+    def get_function(self, name):
+        """
+        Returns a ctypes callable taking one float per argument of the compiled function name.
+        """
+        fptr = self.compiled_functions.get(name)
+        if fptr is None:
+            function = self.generator.functions.get(name)
+            address = self.engine.get_function_address(name) if function is not None else 0
+            if function is None or function.is_declaration or not address:
+                raise LLVMError("Unknown compiled function " + str(name))
+            function_type = CFUNCTYPE(c_double, *([c_double] * len(function.args)))
+            fptr = self.compiled_functions[name] = function_type(address)
+        return fptr
+
+    def profile(self):
+        """
+        Returns {name: {'calls': ..., 'cycles': ...}} for the functions compiled with profile=True,
+        cycles including those spent in callees.
+        """
+        counters = {}
+        for name in self.generator.functions:
+            calls = self.engine.get_global_value_address(name + '.calls')
+            if calls:
+                cycles = self.engine.get_global_value_address(name + '.cycles')
+                counters[name] = {'calls': c_int64.from_address(calls).value,
+                                  'cycles': c_int64.from_address(cycles).value if cycles else 0}
+        return counters
+
+    def apply(self, name, *arrays, threads=1):
+        """
+        Calls the compiled function name element-wise over NumPy arrays, one array per argument,
+        in a native loop. Contiguous float64 inputs are read in place; returns a new float64 array.
+
+        With threads > 1 the arrays are split into that many contiguous chunks, each run on a
+        thread of its own; ctypes releases the GIL for the duration of the native call.
+        """
+        import numpy as np
+
+        function = self.generator.functions.get(name)
+        if function is None:
+            raise LLVMError("Call to unknown function " + str(name))
+        if len(function.args) != len(arrays):
+            raise LLVMError("Function call with incorrect arguments count " + str(name))
+
+        arrays = [np.ascontiguousarray(array, dtype=np.float64) for array in arrays]
+        shape = arrays[0].shape if arrays else ()
+        if any(array.shape != shape for array in arrays):
+            raise ValueError("Arrays of different shapes passed to " + str(name))
+
+        if name not in self.map_functions:
+            self.generator.new_module()
+            self.generator.generate_map_function(name)
+            llvm_mod = self._compile(self.generator.module, optimize=True)[0]
+            map_type = CFUNCTYPE(None, *([c_void_p] * (len(arrays) + 1) + [c_int64]))
+            fptr = map_type(self.engine.get_function_address(name + '.map'))
+            self.map_functions[name] = (fptr, llvm_mod)
+
+        output = np.empty(shape, dtype=np.float64)
+        fptr = self.map_functions[name][0]
+        pointers = [output.ctypes.data] + [array.ctypes.data for array in arrays]
+        itemsize = output.itemsize
+
+        def run_chunk(start, end):
+            fptr(*[pointer + start * itemsize for pointer in pointers], end - start)
+
+        threads = max(1, min(threads, output.size))
+        if threads == 1:
+            run_chunk(0, output.size)
+            return output
+
+        bounds = [output.size * i // threads for i in range(threads + 1)]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # every chunk writes its own slice of output, so the result does not depend on scheduling
+            for future in [executor.submit(run_chunk, start, end) for start, end in zip(bounds, bounds[1:])]:
+                future.result()
+        return output
+
+    def evaluate_program(self, string, optimize=True):
+        """
+        Compiles every item of the program into a single module, optimizes it once
+        and returns the results of the top-level expressions in order.
+        """
+        self.generator.new_module()
+        purity = self.generator.purity
+        saved = dict(self.generator.functions), dict(purity.pure), dict(purity.returns), set(purity.memoized)
+        operators = self.parser.operators_precendence.save()
+        anonymous = []
+        try:
+            for ast in map(self._simplify, self.parser.parse_program(string)):
+                self._generate(self.generator, ast)
+                if isinstance(ast, FunctionNode) and ast.is_anonymous():
+                    anonymous.append(ast.prototype.name)
+                else:
+                    self._invalidate(ast.name if isinstance(ast, PrototypeNode) else ast.prototype.name)
+
+            symbols = self._compile(self.generator.module, optimize)[1]
+        except Exception:
+            # nothing of the program was compiled, so the functions it defined before the error are forgotten
+            self.generator.functions, purity.pure, purity.returns, purity.memoized = saved
+            self.parser.operators_precendence.restore(operators)
+            raise
+        results = []
+        for name in anonymous:
+            fptr = CFUNCTYPE(c_double)(self.engine.get_function_address(symbols[name]))
+            results.append(self._execute(fptr))
+            del self.generator.functions[name]
+        return results
+
+    def evaluate_file(self, path, optimize=True):
+        with open(path, 'r') as f:
+            return self.evaluate_program(f.read(), optimize)
+
+    def compile_program(self, string, optimize=True):
+        """
+        Compiles the program into a standalone optimized module without running it.
+        The module includes the builtins and does not touch the state of the JIT session.
+        """
+        generator = LLVMGenerator(profile=self.generator.profile)
+        self._add_builtins(generator)
+        # a parser of its own, since the parser registers the operators the program defines
+        for ast in map(self._simplify, Parser(self.stats).parse_program(string)):
+            self._generate(generator, ast)
+        return self._optimize(generator.module, optimize)
+
+    def emit(self, llvm_mod, path):
+        """
+        Writes the module to path, the format being chosen by the extension:
+        .ll (textual IR), .bc (bitcode), .s (assembly), .o (object file) or .so (shared library).
+        """
+        extension = os.path.splitext(path)[1]
+        if extension == '.ll':
+            with open(path, 'w') as f:
+                f.write(str(llvm_mod))
+        elif extension == '.bc':
+            with open(path, 'wb') as f:
+                f.write(llvm_mod.as_bitcode())
+        elif extension == '.s':
+            with open(path, 'w') as f:
+                f.write(self.object_target_machine.emit_assembly(llvm_mod))
+        elif extension == '.o':
+            with open(path, 'wb') as f:
+                f.write(self.object_target_machine.emit_object(llvm_mod))
+        elif extension == '.so':
+            with tempfile.TemporaryDirectory() as directory:
+                object_path = os.path.join(directory, 'module.o')
+                self.emit(llvm_mod, object_path)
+                subprocess.check_call([os.environ.get('CC', 'cc'), '-shared', '-o', path, object_path, '-lm'])
+        else:
+            raise ValueError("Unknown output format " + str(extension))
+
+    def compile_file(self, path, output, optimize=True):
+        with open(path, 'r') as f:
+            self.emit(self.compile_program(f.read(), optimize), output)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile and run a Kaleidoscope program.')
+    parser.add_argument('file', help='Kaleidoscope source file')
+    parser.add_argument('--no-optimize', action='store_true', help='skip the LLVM optimization passes')
+    parser.add_argument('-O', dest='opt_level', type=int, default=2, help='LLVM optimization level (default 2)')
+    parser.add_argument('--vectorize', action='store_true', help='enable the loop and SLP vectorizers')
+    parser.add_argument('--cpu', default='host', help="target CPU, 'host' by default")
+    parser.add_argument('--features', default='host', help="target CPU features, 'host' by default")
+    parser.add_argument('-o', '--output',
+                        help='compile to this file (.ll, .bc, .s, .o or .so) instead of running the program')
+    parser.add_argument('--stats', action='store_true', help='print the time spent in each compiler phase')
+    parser.add_argument('--trace', help='write the compiler phases to this file in the Chrome trace format')
+    parser.add_argument('--profile', action='store_true',
+                        help='count the calls and cycles of every function and print them')
+    args = parser.parse_args(argv)
+
+    stats = Stats(trace=args.trace is not None) if args.stats or args.trace else None
+    optimizer = Optimizer(opt_level=args.opt_level, loop_vectorize=args.vectorize, slp_vectorize=args.vectorize)
+    evaluator = Evaluator(optimizer=optimizer, cpu=args.cpu, features=args.features, stats=stats,
+                          profile=args.profile)
+    if args.output:
+        evaluator.compile_file(args.file, args.output, optimize=not args.no_optimize)
+    else:
+        for result in evaluator.evaluate_file(args.file, optimize=not args.no_optimize):
+            print(result)
+
+    if args.profile:
+        for name, counters in sorted(evaluator.profile().items(), key=lambda item: -item[1]['cycles']):
+            print('{0:<20}{1:>12} calls{2:>16} cycles'.format(name, counters['calls'], counters['cycles']),
+                  file=sys.stderr)
+    if args.stats:
+        print(stats, file=sys.stderr)
+    if args.trace:
+        stats.to_chrome_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main()
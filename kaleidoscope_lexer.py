@@ -2,6 +2,8 @@ import re
 
 
 class Token:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -44,7 +46,21 @@ class InToken(Token):
     pass
 
 
+class BinaryToken(Token):
+    pass
+
+
+class UnaryToken(Token):
+    pass
+
+
+class VarToken(Token):
+    pass
+
+
 class NumberToken(Token):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         super().__init__()
         self.value = value
@@ -54,6 +70,8 @@ class NumberToken(Token):
 
 
 class IdentifierToken(Token):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         super().__init__()
         self.name = name
@@ -63,6 +81,8 @@ class IdentifierToken(Token):
 
 
 class CharacterToken(Token):
+    __slots__ = ('char',)
+
     def __init__(self, char):
         super().__init__()
         self.char = char
@@ -78,69 +98,92 @@ class CharacterToken(Token):
 
 
 class OpenParenthesisToken(CharacterToken):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(char='(')
 
 
 class ClosedParenthesisToken(CharacterToken):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(char=')')
 
 
 class AssignToken(CharacterToken):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(char='=')
 
 
 class CommaToken(CharacterToken):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(char=',')
 
 
 class Lexer:
+    # keywords and punctuation carry no state, so every occurrence shares one instance
+    keywords = {
+        'def': DefToken(),
+        'extern': ExternToken(),
+        'if': IfToken(),
+        'then': ThenToken(),
+        'else': ElseToken(),
+        'for': ForToken(),
+        'in': InToken(),
+        'binary': BinaryToken(),
+        'unary': UnaryToken(),
+        'var': VarToken(),
+    }
+    punctuation = {
+        '(': OpenParenthesisToken(),
+        ')': ClosedParenthesisToken(),
+        '=': AssignToken(),
+        ',': CommaToken(),
+    }
+    eof = EOFToken()
+
     def __init__(self):
-        self.regex_comment = re.compile('#.*')
-        self.regex_number = re.compile('(\d+(\.\d*)?|\.\d+)([eE]\d+)?')
-        self.regex_identifier = re.compile('[a-zA-Z][a-zA-Z0-9]*')
+        # a single pass over the source: whitespace, comments, numbers, identifiers,
+        # two character comparison operators, any other character
+        self.regex = re.compile(r'''
+            (?P<space>\s+)
+          | (?P<comment>\#[^\n]*)
+          | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE]\d+)?)
+          | (?P<identifier>[a-zA-Z][a-zA-Z0-9]*)
+          | (?P<char><=|>=|==|!=|.)
+        ''', re.VERBOSE | re.DOTALL)
 
     def tokenize(self, text):
-        while text:
-            if text[0].isspace():
-                text = text[1:]
-                continue
-
-            match_comment = self.regex_comment.match(text)
-            match_number = self.regex_number.match(text)
-            match_identifier = self.regex_identifier.match(text)
-
-            if match_comment:
-                comment = match_comment.group(0)
-                text = text[len(comment):]
-            elif match_number:
-                number = match_number.group(0)
-                yield NumberToken(float(number))
-                text = text[len(number):]
-            elif match_identifier:
-                identifier = match_identifier.group(0)
-                if identifier == 'def':
-                    yield DefToken()
-                elif identifier == 'extern':
-                    yield ExternToken()
-                elif identifier == 'if':
-                    yield IfToken()
-                elif identifier == 'then':
-                    yield ThenToken()
-                elif identifier == 'else':
-                    yield ElseToken()
-                elif identifier == 'for':
-                    yield ForToken()
-                elif identifier == 'in':
-                    yield InToken()
-                else:
-                    yield IdentifierToken(identifier)
-                text = text[len(identifier):]
-            else:
-                yield CharacterToken(text[0])
-                text = text[1:]
-
-        yield EOFToken()
+        for token, _ in self.scan(text):
+            yield token
+
+    def scan(self, text):
+        """
+        Yields (token, offset) pairs, offset being the index of the token in text.
+        """
+        keywords = self.keywords
+        characters = dict(self.punctuation)
+        identifiers = {}
+        for match in self.regex.finditer(text):
+            kind = match.lastgroup
+            if kind == 'number':
+                yield NumberToken(float(match.group())), match.start()
+            elif kind == 'identifier':
+                identifier = match.group()
+                token = keywords.get(identifier) or identifiers.get(identifier)
+                if token is None:
+                    token = identifiers[identifier] = IdentifierToken(identifier)
+                yield token, match.start()
+            elif kind == 'char':
+                char = match.group()
+                token = characters.get(char)
+                if token is None:
+                    token = characters[char] = CharacterToken(char)
+                yield token, match.start()
+
+        yield self.eof, len(text)
@@ -0,0 +1,20 @@
+from ctypes import CDLL, CFUNCTYPE, c_double
+import os
+
+
+class Library:
+    """
+    Shared library emitted by Evaluator.emit. Loading it needs neither the
+    compiler nor llvmlite, only ctypes.
+    """
+
+    def __init__(self, path):
+        self.library = CDLL(os.path.abspath(path))
+        self.functions = {}
+
+    def get_function(self, name, arguments_count):
+        function = self.functions.get(name)
+        if function is None:
+            function_type = CFUNCTYPE(c_double, *([c_double] * arguments_count))
+            function = self.functions[name] = function_type((name, self.library))
+        return function
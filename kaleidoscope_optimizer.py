@@ -0,0 +1,72 @@
+import llvmlite.binding as llvm
+
+
+class Optimizer:
+    """
+    LLVM optimization settings and the pass managers built from them.
+    The module pass manager is built on first use and reused for every module; the
+    function passes run over each defined function before the module passes.
+
+    passes is a list of extra module passes named after the llvmlite
+    add_<name>_pass methods, e.g. ['licm', 'gvn'].
+    """
+
+    def __init__(self, opt_level=2, size_level=0, inlining_threshold=225,
+                 loop_vectorize=False, slp_vectorize=False, passes=()):
+        self.opt_level = opt_level
+        self.size_level = size_level
+        self.inlining_threshold = inlining_threshold
+        self.loop_vectorize = loop_vectorize
+        self.slp_vectorize = slp_vectorize
+        self.passes = list(passes)
+
+        for name in self.passes:
+            if not hasattr(llvm.ModulePassManager, 'add_{0}_pass'.format(name)):
+                raise ValueError("Unknown optimization pass " + str(name))
+
+        self.target_machine = None
+        self.pass_manager_builder = None
+        self.module_pass_manager = None
+
+    def key(self):
+        return (self.opt_level, self.size_level, self.inlining_threshold,
+                self.loop_vectorize, self.slp_vectorize, tuple(self.passes))
+
+    def build(self, target_machine=None):
+        """
+        Builds the pass managers. With a target machine its analysis passes are
+        added, so that cost models (e.g. of the vectorizers) know about the target CPU.
+        """
+        self.target_machine = target_machine
+        self.pass_manager_builder = llvm.create_pass_manager_builder()
+        self.pass_manager_builder.opt_level = self.opt_level
+        self.pass_manager_builder.size_level = self.size_level
+        if self.inlining_threshold is not None:
+            self.pass_manager_builder.inlining_threshold = self.inlining_threshold
+        self.pass_manager_builder.loop_vectorize = self.loop_vectorize
+        self.pass_manager_builder.slp_vectorize = self.slp_vectorize
+
+        self.module_pass_manager = llvm.create_module_pass_manager()
+        if target_machine is not None:
+            target_machine.add_analysis_passes(self.module_pass_manager)
+        self.pass_manager_builder.populate(self.module_pass_manager)
+        for name in self.passes:
+            getattr(self.module_pass_manager, 'add_{0}_pass'.format(name))()
+
+    def run(self, llvm_mod, target_machine=None):
+        if self.module_pass_manager is None or target_machine is not self.target_machine:
+            self.build(target_machine)
+
+        # function pass managers are bound to a module, so only this one is built per call
+        function_pass_manager = llvm.create_function_pass_manager(llvm_mod)
+        if target_machine is not None:
+            target_machine.add_analysis_passes(function_pass_manager)
+        self.pass_manager_builder.populate(function_pass_manager)
+        function_pass_manager.initialize()
+        for function in llvm_mod.functions:
+            if not function.is_declaration:
+                function_pass_manager.run(function)
+        function_pass_manager.finalize()
+
+        self.module_pass_manager.run(llvm_mod)
+        return llvm_mod
@@ -1,23 +1,50 @@
 from AST import NumberExpression, VariableExpression, FunctionCallExpression, PrototypeNode, FunctionNode, \
-    BinaryOperatorExpression, IfExpression, ForExpression
+    BinaryOperatorExpression, UnaryOperatorExpression, IfExpression, ForExpression, VarExpression, dispatch_table
 from kaleidoscope_lexer import CharacterToken, NumberToken, IdentifierToken, EOFToken, DefToken, ExternToken, Lexer, \
     OpenParenthesisToken, ClosedParenthesisToken, IfToken, ThenToken, ElseToken, ForToken, AssignToken, CommaToken, \
-    InToken
-from operators import Operators
+    InToken, BinaryToken, UnaryToken, VarToken
+from kaleidoscope_stats import phase
+from operators import Operators, BINARY_PRECEDENCE, DEFAULT_PRECEDENCE, OVERRIDABLE, RESERVED, RIGHT_ASSOCIATIVE
 
 
 class ParserException(Exception):
-    pass
+    def __init__(self, message, line=None, column=None):
+        if line is not None:
+            message = '{0} at line {1}, column {2}'.format(message, line, column)
+        super().__init__(message)
+        self.line = line
+        self.column = column
 
 
 class Parser:
-    def __init__(self):
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.text = None
         self.tokens = None
         self.current = None
+        self.offset = 0
         self.operators_precendence = Operators()
+        self._flatteners = dispatch_table(self, '_flatten_')
+
+    def start(self, string):
+        self.text = string
+        if self.stats is None:
+            self.tokens = Lexer().scan(string)
+        else:
+            # lexed up front so that lexing and parsing are timed apart
+            with self.stats.phase('lex'):
+                tokens = list(Lexer().scan(string))
+            self.stats.count('tokens', len(tokens))
+            self.tokens = iter(tokens)
+        self.next()
 
     def next(self):
-        self.current = next(self.tokens)
+        self.current, self.offset = next(self.tokens)
+
+    def location(self):
+        line = self.text.count('\n', 0, self.offset) + 1
+        column = self.offset - self.text.rfind('\n', 0, self.offset)
+        return line, column
 
     def parse_number_expression(self):
         """
@@ -33,33 +60,66 @@ class Parser:
         """
         self.next()  # consume '('
         contents = self.parse_expression()
-        if self.current != ClosedParenthesisToken():
+        if not isinstance(self.current, ClosedParenthesisToken):
             raise ParserException("Expected ')', got " + str(self.current))
         self.next()  # consume ')'
         return contents
 
     def parse_expression(self):
         """
-        expression ::= primary binoprhs
-        """
-        left = self.parse_primary_expression()
-        return self.parse_binary_op(left, 0)
+        expression ::= unary binoprhs
+        binoprhs ::= (operator unary)*
+        unary ::= primary | unaryoperator unary
 
-    def parse_binary_op(self, left, left_precedence):
-        """
-        binoprhs ::= (operator primary)*
+        Operators and parentheses are kept on an explicit stack (shunting-yard), so long operator
+        chains and deeply nested parentheses are parsed in linear time without recursion.
         """
+        operands = []
+        operators = []  # (precedence, operator) of a binary operator, a unary operator, or None for '('
+        depth = 0
         while True:
-            precedence = self.operators_precendence.get(self.current)
-            if precedence < left_precedence:
-                return left
-            operator = self.current.char
-            self.next()
-            right = self.parse_primary_expression()
-            next_precedence = self.operators_precendence.get(self.current)
-            if precedence < next_precedence:
-                right = self.parse_binary_op(right, precedence + 1)
-            left = BinaryOperatorExpression(operator, left, right)
+            while True:
+                if isinstance(self.current, OpenParenthesisToken):
+                    operators.append(None)
+                    depth += 1
+                elif self.operators_precendence.is_unary(self.current):
+                    operators.append(self.current.char)
+                else:
+                    break
+                self.next()
+            operands.append(self.parse_primary_expression())
+            self._apply_unary(operands, operators)
+
+            while True:
+                precedence = self.operators_precendence.get(self.current)
+                if precedence >= 0:
+                    # a right associative operator leaves operators of its own precedence on the stack
+                    self._reduce(operands, operators,
+                                 precedence + 1 if self.current.char in RIGHT_ASSOCIATIVE else precedence)
+                    operators.append((precedence, self.current.char))
+                    self.next()
+                    break
+                if depth == 0:
+                    self._reduce(operands, operators, 0)
+                    return operands[0]
+                if not isinstance(self.current, ClosedParenthesisToken):
+                    raise ParserException("Expected ')', got " + str(self.current))
+                self._reduce(operands, operators, 0)
+                operators.pop()
+                depth -= 1
+                self.next()
+                self._apply_unary(operands, operators)
+
+    def _reduce(self, operands, operators, precedence):
+        while operators and isinstance(operators[-1], tuple) and operators[-1][0] >= precedence:
+            right = operands.pop()
+            left = operands.pop()
+            operands.append(BinaryOperatorExpression(operators.pop()[1], left, right))
+
+    def _apply_unary(self, operands, operators):
+        # unary operators bind tighter than any binary one, so they apply as soon as their operand is complete
+        while operators and isinstance(operators[-1], str):
+            operands.append(UnaryOperatorExpression(operators.pop(), operands.pop()))
 
     def parse_if_expression(self):
         """
@@ -87,18 +147,18 @@ class Parser:
 
         loop_variable = self.current.name
         self.next()
-        if self.current != AssignToken():
+        if not isinstance(self.current, AssignToken):
             raise ParserException("Expected '=' after variable in for, got " + str(self.current))
         self.next()
         start = self.parse_expression()
 
-        if self.current != CommaToken():
+        if not isinstance(self.current, CommaToken):
             raise ParserException("Expected ',' after variable start value in for, got " + str(self.current))
         self.next()
 
         end = self.parse_expression()
 
-        if self.current == CommaToken():
+        if isinstance(self.current, CommaToken):
             self.next()
             step = self.parse_expression()
         else:
@@ -111,23 +171,50 @@ class Parser:
         body = self.parse_expression()
         return ForExpression(loop_variable, start, end, step, body)
 
+    def parse_var_expression(self):
+        """
+        varexpr ::= 'var' identifier ('=' expression)? (',' identifier ('=' expression)?)* 'in' expression
+        """
+        self.next()
+        variables = []
+        while True:
+            if not isinstance(self.current, IdentifierToken):
+                raise ParserException("Expected identifier after 'var', got " + str(self.current))
+            name = self.current.name
+            self.next()
+            initializer = None
+            if isinstance(self.current, AssignToken):
+                self.next()
+                initializer = self.parse_expression()
+            variables.append((name, initializer))
+            if not isinstance(self.current, CommaToken):
+                break
+            self.next()
+
+        if not isinstance(self.current, InToken):
+            raise ParserException("Expected 'in' after 'var', got " + str(self.current))
+        self.next()
+
+        body = self.parse_expression()
+        return VarExpression(variables, body)
+
     def parse_identifier_expression(self):
         """
         identifierexpr ::= identifier | identifier '(' expression* ')'
         """
         identifier_name = self.current.name
         self.next()
-        if self.current != OpenParenthesisToken():
+        if not isinstance(self.current, OpenParenthesisToken):
             return VariableExpression(identifier_name)
 
         self.next()  # consume '('
         arguments = []
-        if self.current != ClosedParenthesisToken():
+        if not isinstance(self.current, ClosedParenthesisToken):
             while True:
                 arguments.append(self.parse_expression())
-                if self.current == ClosedParenthesisToken():
+                if isinstance(self.current, ClosedParenthesisToken):
                     break
-                if self.current != CommaToken():
+                if not isinstance(self.current, CommaToken):
                     raise ParserException("Expected ',' or ')' in the argument list")
                 self.next()
         self.next()  # consume ')'
@@ -135,7 +222,7 @@ class Parser:
 
     def parse_primary_expression(self):
         """
-        primary ::= identifierexpr | numberexpr | parenexpr | ifexpression | forexpression
+        primary ::= identifierexpr | numberexpr | parenexpr | ifexpression | forexpression | varexpression
         """
         if isinstance(self.current, IdentifierToken):
             return self.parse_identifier_expression()
@@ -145,39 +232,90 @@ class Parser:
             return self.parse_if_expression()
         elif isinstance(self.current, ForToken):
             return self.parse_for_expression()
-        elif self.current == OpenParenthesisToken():
+        elif isinstance(self.current, VarToken):
+            return self.parse_var_expression()
+        elif isinstance(self.current, OpenParenthesisToken):
             return self.parse_parenthesis_expression()
         else:
             raise ParserException("Unknown token when parsing primary: " + str(self.current))
 
-    def parse_prototype_expression(self):
+    def parse_prototype_expression(self, function_name=None):
         """
         prototype ::= id '(' id* ')'
+                    | 'binary' operator number? '(' id id ')'
+                    | 'unary' operator '(' id ')'
+
+        function_name is given when the name was already read.
         """
-        if not isinstance(self.current, IdentifierToken):
+        operands_count = None
+        if function_name is not None:
+            pass
+        elif isinstance(self.current, IdentifierToken):
+            function_name = self.current.name
+            self.next()
+        elif isinstance(self.current, (BinaryToken, UnaryToken)):
+            binary = isinstance(self.current, BinaryToken)
+            self.next()
+            if not isinstance(self.current, CharacterToken) or self.current.char in RESERVED:
+                raise ParserException("Expected operator after 'binary' or 'unary', got " + str(self.current))
+            operator = self.current.char
+            self.next()
+            if binary:
+                if operator in BINARY_PRECEDENCE and operator not in OVERRIDABLE:
+                    raise ParserException("Cannot redefine builtin operator " + operator)
+                function_name, operands_count = 'binary' + operator, 2
+                precedence = DEFAULT_PRECEDENCE
+                if isinstance(self.current, NumberToken):
+                    precedence = self.current.value
+                    if not 1 <= precedence <= 100:
+                        raise ParserException("Invalid precedence: must be 1..100")
+                    self.next()
+            else:
+                function_name, operands_count = 'unary' + operator, 1
+        else:
             raise ParserException("Expected function name in prototype")
-        function_name = self.current.name
-        self.next()
-        if self.current != OpenParenthesisToken():
+        if not isinstance(self.current, OpenParenthesisToken):
             raise ParserException("Expected '(' in function prototype")
         self.next()
         argument_names = []
         while isinstance(self.current, IdentifierToken):
             argument_names.append(self.current.name)
             self.next()
-        if self.current != ClosedParenthesisToken():
+        if not isinstance(self.current, ClosedParenthesisToken):
             raise ParserException("Expected ')' in function prototype")
         self.next()
+
+        if operands_count is not None:
+            if len(argument_names) != operands_count:
+                raise ParserException("Invalid number of operands for operator " + function_name)
+            # the operator can be used from here on, including in the body of its own definition
+            if binary:
+                self.operators_precendence.add_binary(operator, precedence)
+            else:
+                self.operators_precendence.add_unary(operator)
         return PrototypeNode(function_name, argument_names)
 
     def parse_definition(self):
         """
-        definition ::= 'def' prototype expression
+        definition ::= 'def' 'memo'? prototype expression
         """
         self.next()
-        prototype = self.parse_prototype_expression()
-        expression = self.parse_expression()
-        return FunctionNode(prototype, expression)
+        memoize = False
+        function_name = None
+        if isinstance(self.current, IdentifierToken) and self.current.name == 'memo':
+            # memo is not a keyword: followed by a '(' it is the name of the function
+            self.next()
+            memoize = isinstance(self.current, (IdentifierToken, BinaryToken, UnaryToken))
+            if not memoize:
+                function_name = 'memo'
+        operators = self.operators_precendence.save()
+        try:
+            prototype = self.parse_prototype_expression(function_name)
+            expression = self.parse_expression()
+        except ParserException:
+            self.operators_precendence.restore(operators)
+            raise
+        return FunctionNode(prototype, expression, memoize)
 
     def parse_external(self):
         """
@@ -193,42 +331,112 @@ class Parser:
         expression = self.parse_expression()
         return FunctionNode.create_anonymous(expression)
 
-    def parse(self, string):
+    def parse_toplevel(self):
         """
-        top ::= definition | external | expression | EOF
+        top ::= definition | external | expression
         """
-
-        lexer = Lexer()
-        self.tokens = lexer.tokenize(string)
-        self.next()
-
-        if isinstance(self.current, EOFToken):
-            pass
-        elif isinstance(self.current, DefToken):
-            print('Parsed a function definition.')
+        if isinstance(self.current, DefToken):
             return self.parse_definition()
         elif isinstance(self.current, ExternToken):
-            print('Parsed an extern.')
             return self.parse_external()
         else:
-            print('Parsed a top-level expression.')
             return self.parse_toplevel_expression()
 
+    def parse(self, string):
+        """
+        top ::= definition | external | expression | EOF
+        """
+        self.start(string)
+
+        try:
+            with phase(self.stats, 'parse'):
+                if isinstance(self.current, EOFToken):
+                    pass
+                elif isinstance(self.current, DefToken):
+                    print('Parsed a function definition.')
+                    return self.parse_definition()
+                elif isinstance(self.current, ExternToken):
+                    print('Parsed an extern.')
+                    return self.parse_external()
+                else:
+                    print('Parsed a top-level expression.')
+                    return self.parse_toplevel_expression()
+        except ParserException as e:
+            raise ParserException(str(e), *self.location()) from e
+
+    def parse_program(self, string):
+        """
+        program ::= [top ';'?]* EOF
+
+        Lexes the whole string once and yields each top-level item as soon as it is parsed.
+        """
+        self.start(string)
+
+        try:
+            while not isinstance(self.current, EOFToken):
+                if isinstance(self.current, CharacterToken) and self.current.char == ';':
+                    self.next()
+                    continue
+                with phase(self.stats, 'parse'):
+                    ast = self.parse_toplevel()
+                yield ast
+        except ParserException as e:
+            raise ParserException(str(e), *self.location()) from e
+
     def _flatten(self, ast):
-        if isinstance(ast, NumberExpression):
-            return ['Number', ast.value]
-        elif isinstance(ast, VariableExpression):
-            return ['Variable', ast.name]
-        elif isinstance(ast, BinaryOperatorExpression):
-            return ['Binop', ast.operator,
-                    self._flatten(ast.left), self._flatten(ast.right)]
-        elif isinstance(ast, FunctionCallExpression):
-            args = [self._flatten(arg) for arg in ast.arguments]
-            return ['Call', ast.function, args]
-        elif isinstance(ast, PrototypeNode):
-            return ['Prototype', ast.name, ' '.join(ast.arguments)]
-        elif isinstance(ast, FunctionNode):
-            return ['Function',
-                    self._flatten(ast.prototype), self._flatten(ast.body)]
-        else:
+        flatten = self._flatteners.get(ast.__class__)
+        if flatten is None:
             raise TypeError('unknown type in _flatten: {0}'.format(type(ast)))
+        return flatten(ast)
+
+    def _flatten_number_expression(self, ast):
+        return ['Number', ast.value]
+
+    def _flatten_variable_expression(self, ast):
+        return ['Variable', ast.name]
+
+    def _flatten_unary_operator_expression(self, ast):
+        return ['Unary', ast.operator, self._flatten(ast.operand)]
+
+    def _flatten_binary_operator_expression(self, ast):
+        # nested operators are flattened with an explicit stack rather than recursion
+        values = []
+        stack = [(ast, False)]
+        while stack:
+            node, ready = stack.pop()
+            if ready:
+                right = values.pop()
+                left = values.pop()
+                values.append(['Binop', node.operator, left, right])
+            elif isinstance(node, BinaryOperatorExpression):
+                stack.extend(((node, True), (node.right, False), (node.left, False)))
+            else:
+                values.append(self._flatten(node))
+        return values[0]
+
+    def _flatten_function_call_expression(self, ast):
+        args = [self._flatten(arg) for arg in ast.arguments]
+        return ['Call', ast.function, args]
+
+    def _flatten_if_expression(self, ast):
+        return ['If', self._flatten(ast.condition),
+                self._flatten(ast.then_branch), self._flatten(ast.else_branch)]
+
+    def _flatten_for_expression(self, ast):
+        step = None if ast.step is None else self._flatten(ast.step)
+        return ['For', ast.variable, self._flatten(ast.start), self._flatten(ast.end),
+                step, self._flatten(ast.body)]
+
+    def _flatten_var_expression(self, ast):
+        variables = [[name, None if initializer is None else self._flatten(initializer)]
+                     for name, initializer in ast.variables]
+        return ['Var', variables, self._flatten(ast.body)]
+
+    def _flatten_prototype_node(self, ast):
+        return ['Prototype', ast.name, ' '.join(ast.arguments)]
+
+    def _flatten_function_node(self, ast):
+        flat = ['Function', self._flatten(ast.prototype), self._flatten(ast.body)]
+        if ast.memoize:
+            flat.append('memo')
+        return flat
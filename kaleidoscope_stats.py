@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Stats:
+    """
+    Time spent in each phase of the compiler (lex, parse, simplify, codegen, parse_assembly, optimize,
+    finalize, execute) and counters of the work done (tokens, nodes, instructions before and after
+    optimization, bytes of object code).
+
+    With trace=True every phase is also kept as an event, for output in the Chrome trace format.
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.events = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.times[name] = self.times.get(name, 0.0) + elapsed
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.trace:
+                self.events.append((name, start, elapsed, threading.get_ident()))
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        phases = {name: {'seconds': seconds, 'calls': self.calls[name]} for name, seconds in self.times.items()}
+        return {'phases': phases, 'counters': dict(self.counters)}
+
+    def to_json(self, path=None):
+        return self._dump(self.as_dict(), path)
+
+    def to_chrome_trace(self, path=None):
+        """
+        Returns the recorded events in the Chrome trace event format (chrome://tracing, Perfetto),
+        writing them to path as well when given.
+        """
+        pid = os.getpid()
+        events = [{'name': name, 'cat': 'compiler', 'ph': 'X', 'ts': start * 1e6, 'dur': elapsed * 1e6,
+                   'pid': pid, 'tid': tid}
+                  for name, start, elapsed, tid in self.events]
+        return self._dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, path)
+
+    def _dump(self, data, path):
+        text = json.dumps(data, indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def __str__(self):
+        lines = ['{0:<20}{1:>12.6f} s{2:>8} x'.format(name, seconds, self.calls[name])
+                 for name, seconds in self.times.items()]
+        lines += ['{0:<20}{1:>12}'.format(name, value) for name, value in self.counters.items()]
+        return '\n'.join(lines)
+
+
+def phase(stats, name):
+    # a no-op when stats are disabled
+    return nullcontext() if stats is None else stats.phase(name)
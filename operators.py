@@ -1,19 +1,58 @@
 from kaleidoscope_lexer import CharacterToken
 
+# precedence of the builtin binary operators, higher binds tighter
+BINARY_PRECEDENCE = {
+    '=': 2,
+    '|': 5,
+    '&': 6,
+    '<': 10,
+    '>': 10,
+    '<=': 10,
+    '>=': 10,
+    '==': 10,
+    '!=': 10,
+    '+': 20,
+    '-': 20,
+    '*': 40,
+    '/': 40
+}
+
+# builtin operators a definition may replace, the others cannot be redefined
+OVERRIDABLE = {'&', '|'}
+
+# operators grouping from the right, e.g. a = b = c is a = (b = c)
+RIGHT_ASSOCIATIVE = {'='}
+
+# precedence given to user defined binary operators declared without one
+DEFAULT_PRECEDENCE = 30
+
+# characters with a meaning of their own in the grammar, which cannot be made into operators
+RESERVED = set('(),;=')
+
 
 class Operators:
 
+    def __init__(self):
+        self.precedence = dict(BINARY_PRECEDENCE)
+        self.unary = set()
+
     def get(self, token):
         if isinstance(token, CharacterToken):
-            return self._operators().get(token.char, -1)
+            return self.precedence.get(token.char, -1)
         return -1
 
-    def _operators(self):
-        return {
-            '<': 10,
-            '>': 10,
-            '+': 20,
-            '-': 20,
-            '*': 40,
-            '/': 40
-        }
+    def is_unary(self, token):
+        return isinstance(token, CharacterToken) and token.char in self.unary
+
+    def add_binary(self, char, precedence=DEFAULT_PRECEDENCE):
+        self.precedence[char] = precedence
+
+    def add_unary(self, char):
+        self.unary.add(char)
+
+    def save(self):
+        return dict(self.precedence), set(self.unary)
+
+    def restore(self, state):
+        # forgets the operators of a definition which failed
+        self.precedence, self.unary = state
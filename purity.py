@@ -0,0 +1,78 @@
+from AST import walk, FunctionCallExpression, BinaryOperatorExpression, UnaryOperatorExpression, ForExpression
+
+# externs of the C math library: they touch no memory visible to kaleidoscope, never unwind and always return
+PURE_EXTERNS = {
+    'sqrt', 'cbrt', 'fabs', 'floor', 'ceil', 'trunc', 'round', 'fmod', 'fmin', 'fmax', 'fma', 'hypot',
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2', 'sinh', 'cosh', 'tanh',
+    'exp', 'exp2', 'log', 'log2', 'log10', 'pow'
+}
+
+
+class PurityAnalysis:
+    """
+    Infers over the call graph which functions are pure, i.e. call only pure functions, so that they
+    neither read nor write memory and never unwind. A pure function surely returns as well when it has
+    no loop, does not call itself and calls only functions which surely return.
+    Functions are analysed as they are defined, so calls to functions defined later count as impure.
+    """
+
+    def __init__(self):
+        self.pure = {}
+        self.returns = {}
+        # memoized functions, impure only through their table of results
+        self.memoized = set()
+
+    def add_extern(self, prototype):
+        if prototype.name not in self.pure:
+            self.pure[prototype.name] = self.returns[prototype.name] = prototype.name in PURE_EXTERNS
+
+    def add_function(self, node):
+        name = node.prototype.name
+        if node.memoize:
+            self.memoized.add(name)
+        # a memoized function writes its table of results
+        pure = returns = not node.memoize
+        for child in walk(node.body):
+            if isinstance(child, ForExpression):
+                returns = False
+            callee = self.callee(child)
+            if callee == name:
+                returns = False
+            elif callee is not None:
+                pure = pure and self.pure.get(callee, False)
+                returns = returns and self.returns.get(callee, False)
+        if self.pure.get(name, False):
+            # a definition replacing an extern assumed pure, which its callers relied on, e.g. it may call them
+            pure = False
+        self.pure[name] = pure
+        self.returns[name] = pure and returns
+
+    def memoizable(self, node):
+        """
+        Whether the body of the function calls only pure functions, itself and other memoized functions,
+        so that skipping it for cached arguments loses no side effect.
+        """
+        name = node.prototype.name
+        for child in walk(node.body):
+            callee = self.callee(child)
+            if callee is not None and callee != name and not self.pure.get(callee, False) \
+                    and callee not in self.memoized:
+                return False
+        return True
+
+    def callee(self, node):
+        if isinstance(node, FunctionCallExpression):
+            return node.function
+        elif isinstance(node, UnaryOperatorExpression):
+            return 'unary' + node.operator
+        elif isinstance(node, BinaryOperatorExpression) and 'binary' + node.operator in self.pure:
+            # the builtin operators are pure, unless redefined like '&' and '|' can be
+            return 'binary' + node.operator
+        return None
+
+    def attributes(self, name):
+        if not self.pure.get(name, False):
+            return ()
+        if self.returns[name]:
+            return 'nounwind', 'readnone', 'willreturn'
+        return 'nounwind', 'readnone'
@@ -0,0 +1,62 @@
+import unittest
+
+from AST import NumberExpression, VariableExpression
+from AST_optimizer import ASTOptimizer
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_parser import Parser
+
+
+class TestASTOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser()
+        self.optimizer = ASTOptimizer()
+
+    def optimize(self, string):
+        return self.parser._flatten(self.optimizer.optimize(self.parser.parse(string)).body)
+
+    def test_folding(self):
+        self.assertEqual(self.optimize('1 + 2 * 3 - 4 / 2'), ['Number', 5.0])
+        self.assertEqual(self.optimize('x * (2 + 3)'), ['Binop', '*', ['Variable', 'x'], ['Number', 5.0]])
+        self.assertEqual(self.optimize('1 < 2'), ['Number', 1.0])
+        self.assertEqual(self.optimize('1 / 0'), ['Binop', '/', ['Number', 1.0], ['Number', 0.0]])
+        self.assertEqual(self.optimizer.stats['folded'], 6)
+
+    def test_identities(self):
+        self.assertEqual(self.optimize('(x - 0) * 1 - (2 - 2)'), ['Variable', 'x'])
+        self.assertEqual(self.optimize('1 * foo(x / 1)'), ['Call', 'foo', [['Variable', 'x']]])
+        self.assertEqual(self.optimize('x + 0 * (0 - 1)'), ['Variable', 'x'])
+        self.assertEqual(self.optimize('x * 0'), ['Binop', '*', ['Variable', 'x'], ['Number', 0.0]])
+        # -0 + 0 is +0, and -0 - (-0) as well
+        self.assertEqual(self.optimize('x + 0'), ['Binop', '+', ['Variable', 'x'], ['Number', 0.0]])
+        self.assertEqual(self.optimize('0 + x'), ['Binop', '+', ['Number', 0.0], ['Variable', 'x']])
+        self.assertEqual(self.optimize('x - 0 * (0 - 1)'), ['Binop', '-', ['Variable', 'x'], ['Number', -0.0]])
+        self.assertEqual(self.optimizer.stats['identities'], 6)
+
+    def test_branches(self):
+        self.assertEqual(self.optimize('if 1 < 2 then x else y'), ['Variable', 'x'])
+        self.assertEqual(self.optimize('if 2 - 2 then x else y - 0'), ['Variable', 'y'])
+        self.assertEqual(self.optimize('if x then 1 + 1 else 3')[0], 'If')
+        self.assertEqual(self.optimizer.stats['branches'], 2)
+
+    def test_deep(self):
+        body = self.optimizer.optimize(self.parser.parse('x' + ' - 1 * 0' * 50000).body)
+        self.assertIsInstance(body, VariableExpression)
+        self.assertIsInstance(self.optimizer.optimize(self.parser.parse('1' + ' + 1' * 50000).body),
+                              NumberExpression)
+
+    def test_evaluator_toggle(self):
+        program = '''
+            def foo(x) if 3 < 2 then x * 1 else (x + 0) * (2 + 2);
+            foo(3);
+            1 < 0/0;
+            if 0/0 then 1 else 2;
+            10 / 0 > 5;
+            def nz(x) x + 0;
+            1 / nz(0 * (0 - 1));
+        '''
+        results = [12.0, 1.0, 2.0, 1.0, float('inf')]
+        simplified = Evaluator()
+        self.assertEqual(simplified.evaluate_program(program), results)
+        self.assertEqual(Evaluator(simplify=False).evaluate_program(program), results)
+        self.assertGreater(simplified.ast_optimizer.stats['folded'], 0)
+        self.assertIsNone(Evaluator(simplify=False).ast_optimizer)
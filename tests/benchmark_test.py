@@ -0,0 +1,34 @@
+import unittest
+
+from kaleidoscope_benchmark import BENCHMARKS, run_benchmarks, compare, synthetic_program
+from kaleidoscope_evaluator import Evaluator
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_program(self):
+        program = synthetic_program(100)
+        self.assertEqual(program, synthetic_program(100))
+        self.assertEqual(len(Evaluator().evaluate_program(program + '\nf99(1, 2);')), 1)
+
+    def test_run(self):
+        results = run_benchmarks(['lex', 'fib', 'repeated_evaluate'], scale=0.01, repeat=1)
+        self.assertEqual(set(results['benchmarks']), {'lex', 'fib', 'repeated_evaluate'})
+        for result in results['benchmarks'].values():
+            self.assertGreater(result['median'], 0)
+            self.assertGreater(result['peak_memory'], 0)
+        self.assertEqual(results['metadata']['scale'], 0.01)
+
+    def test_all_benchmarks(self):
+        results = run_benchmarks(scale=0.001, repeat=1)
+        self.assertEqual(set(results['benchmarks']), set(BENCHMARKS))
+
+    def test_compare(self):
+        baseline = {'benchmarks': {'lex': {'median': 1.0}, 'fib': {'median': 1.0}, 'gone': {'median': 1.0}}}
+        results = {'benchmarks': {'lex': {'median': 1.05}, 'fib': {'median': 1.5}, 'new': {'median': 1.0}}}
+        ratios, regressions = compare(results, baseline, threshold=0.1)
+        self.assertEqual(ratios, {'lex': 1.05, 'fib': 1.5})
+        self.assertEqual(regressions, ['fib'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kaleidoscope_cache import ObjectCache
+from kaleidoscope_evaluator import Evaluator
+
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_session(self, cache, *expressions, **options):
+        evaluator = Evaluator(cache=cache, **options)
+        for expression in expressions:
+            evaluator.evaluate(expression)
+        evaluator.evaluate('def adder(x y) x+y')
+        evaluator.evaluate('def fib(x) if x < 3 then 1 else fib(x-1) + fib(x-2)')
+        return evaluator.evaluate('fib(adder(10, 5))')
+
+    def test_hits(self):
+        cache = ObjectCache(self.directory)
+        self.assertEqual(self.run_session(cache), 610.0)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 4})
+
+        # a session which evaluated something else first numbers its anonymous functions differently
+        self.assertEqual(self.run_session(cache, '1 + 1'), 610.0)
+        self.assertEqual(cache.stats(), {'hits': 4, 'misses': 5})
+
+    def test_target_options(self):
+        cache = ObjectCache(self.directory)
+        self.run_session(cache)
+        self.run_session(cache, codegen_opt_level=0)
+        self.run_session(cache, code_model='large')
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 12})
+
+    def test_distinct_keys(self):
+        cache = ObjectCache(self.directory)
+        self.assertNotEqual(cache.key('def', 2, 'x86_64'), cache.key('def', 0, 'x86_64'))
+        self.assertEqual(cache.key('def', 2, 'x86_64'), cache.key('def', 2, 'x86_64'))
+
+    def test_eviction(self):
+        cache = ObjectCache(self.directory, max_size=10)
+        cache.store('first', b'12345')
+        os.utime(cache.path('first'), (0, 0))
+        cache.store('second', b'12345')
+        os.utime(cache.path('second'), (1, 1))
+        cache.load('first')
+        cache.store('third', b'12345')
+        self.assertIsNotNone(cache.load('first'))
+        self.assertIsNone(cache.load('second'))
+        self.assertIsNotNone(cache.load('third'))
@@ -1,6 +1,15 @@
 import unittest
 
+import llvmlite.binding as llvm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from LLVM_code_generator import LLVMError, LLVMGenerator
 from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_parser import Parser
 
 
 class TestEvaluator(unittest.TestCase):
@@ -58,6 +67,16 @@ class TestEvaluator(unittest.TestCase):
         self.assertEqual(self.evaluator.evaluate('foo(10, 2, 300)'), 4)
         self.assertEqual(self.evaluator.evaluate('foo(100, 2000, 30)'), 60)
 
+    def test_if_in_else(self):
+        # an if nested in the else branch of an if which is not returned directly
+        generator = LLVMGenerator()
+        generator.generate_llvm(Parser().parse('def bar(a b) 1 + (if a < b then a else if b < 10 then b else 10)'))
+        llvm.parse_assembly(str(generator.module)).verify()
+        self.evaluator.evaluate('def bar(a b) 1 + (if a < b then a else if b < 10 then b else 10)')
+        self.assertEqual(self.evaluator.evaluate('bar(1, 2)'), 2)
+        self.assertEqual(self.evaluator.evaluate('bar(5, 2)'), 3)
+        self.assertEqual(self.evaluator.evaluate('bar(50, 20)'), 11)
+
     def test_for(self):
         self.evaluator.evaluate('''
             def foo(a b c)
@@ -69,3 +88,228 @@ class TestEvaluator(unittest.TestCase):
 
     def test_putchard(self):
         self.evaluator.evaluate('def foo(a b) for x = 65, x < a, b in putchard(x)')
+
+    def test_anonymous_modules_removed(self):
+        self.evaluator.evaluate("def adder(x y) x+y")
+        known = set(self.evaluator.generator.functions)
+        for i in range(20):
+            self.assertEqual(self.evaluator.evaluate("adder({0}, 1)".format(i)), i + 1)
+        self.assertEqual(set(self.evaluator.generator.functions), known)
+
+    def test_failed_definition(self):
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate("def foo(x) bar(x)")
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate("foo(1)")
+        self.evaluator.evaluate("def foo(x) x*2")
+        self.assertEqual(self.evaluator.evaluate("foo(4)"), 8.0)
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate("def foo(x) x*3")
+
+    def test_program(self):
+        results = self.evaluator.evaluate_program("""
+            extern ceil(x);
+            def adder(x y) x+y;
+            adder(1, 2);
+            def twice(x) adder(x, x);
+            twice(ceil(1.5)) + adder(1, 1);
+        """)
+        self.assertEqual(results, [3.0, 6.0])
+        self.assertEqual(self.evaluator.evaluate("twice(5)"), 10.0)
+
+    def test_failed_program(self):
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate_program('def a(x) x+1; def b(x) c(x)')
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('a(1)')
+        self.assertEqual(self.evaluator.evaluate_program('def a(x) x+1; a(1)'), [2.0])
+
+    def test_expression_cache(self):
+        self.evaluator.evaluate("def adder(x y) x+y")
+        self.assertEqual(self.evaluator.evaluate("adder(1, 2)"), 3.0)
+        self.assertEqual(self.evaluator.evaluate("adder( 1,2 ) # same expression"), 3.0)
+        self.assertEqual(len(self.evaluator.expressions), 1)
+
+    def test_expression_cache_signed_zero(self):
+        self.assertEqual(self.evaluator.evaluate("1/(0*(0-1))"), float('-inf'))
+        self.assertEqual(self.evaluator.evaluate("1/(0*1)"), float('inf'))
+        # code compiled with optimizations is not reused without them
+        self.evaluator.evaluate("1+1")
+        self.evaluator.evaluate("1+1", optimize=False)
+        self.assertEqual(len(self.evaluator.expressions), 4)
+
+    def test_expression_cache_size(self):
+        evaluator = Evaluator(expressions_cache_size=2)
+        for i in range(5):
+            self.assertEqual(evaluator.evaluate("{0} + 1".format(i)), i + 1)
+        self.assertEqual(len(evaluator.expressions), 2)
+        self.assertEqual(evaluator.evaluate("4 + 1"), 5.0)
+
+    def test_expression_cache_invalidation(self):
+        self.evaluator.evaluate('extern hypot(x y)')
+        self.assertEqual(self.evaluator.evaluate('hypot(3, 4)'), 5.0)
+        self.evaluator.evaluate('def hypot(x y) x+y')
+        self.assertEqual(self.evaluator.evaluate('hypot(3, 4)'), 7.0)
+
+    def test_target_cpu(self):
+        self.assertEqual(self.evaluator.cpu, llvm.get_host_cpu_name())
+        evaluator = Evaluator(cpu='', features='', code_model='default', codegen_opt_level=0)
+        evaluator.evaluate("def adder(x y) x+y")
+        self.assertEqual(evaluator.evaluate("adder(5, 4)"), 9.0)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_apply(self):
+        self.evaluator.evaluate("def adder(x y) x+y*2")
+        x = numpy.arange(1000.0)
+        y = numpy.linspace(0, 1, 1000)
+        numpy.testing.assert_array_equal(self.evaluator.apply('adder', x, y), x + y * 2)
+        numpy.testing.assert_array_equal(self.evaluator.apply('adder', [[1, 2]], [[3, 4]]), [[7.0, 10.0]])
+        self.assertEqual(len(self.evaluator.apply('adder', [], [])), 0)
+        with self.assertRaises(ValueError):
+            self.evaluator.apply('adder', [1, 2], [3])
+        with self.assertRaises(LLVMError):
+            self.evaluator.apply('adder', x)
+        with self.assertRaises(LLVMError):
+            self.evaluator.apply('nosuch', x)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_apply_threads(self):
+        self.evaluator.evaluate("def f(x y) if x < y then x*y else x-y")
+        x = numpy.random.RandomState(0).uniform(0, 10, 10001)
+        y = numpy.random.RandomState(1).uniform(0, 10, 10001)
+        expected = self.evaluator.apply('f', x, y)
+        for threads in (2, 3, 8):
+            numpy.testing.assert_array_equal(self.evaluator.apply('f', x, y, threads=threads), expected)
+        numpy.testing.assert_array_equal(self.evaluator.apply('f', [1], [2], threads=4), [2.0])
+
+    def test_get_function(self):
+        self.evaluator.evaluate("def fib(x) if x < 3 then 1 else fib(x-1) + fib(x-2)")
+        self.evaluator.evaluate("def three() 3")
+        fib = self.evaluator.get_function('fib')
+        self.assertEqual(fib(20), 6765.0)
+        self.assertIs(self.evaluator.get_function('fib'), fib)
+        self.assertEqual(self.evaluator.get_function('three')(), 3.0)
+        self.evaluator.evaluate('extern ceil(x)')
+        with self.assertRaises(LLVMError):
+            self.evaluator.get_function('ceil')
+        with self.assertRaises(LLVMError):
+            self.evaluator.get_function('nosuch')
+
+    def test_deep_expressions(self):
+        self.assertEqual(self.evaluator.evaluate("0" + " + 1" * 20000), 20000.0)
+        self.assertEqual(self.evaluator.evaluate("(" * 5000 + "1" + " + 1)" * 5000), 5001.0)
+
+    def test_user_operators(self):
+        results = self.evaluator.evaluate_program('''
+            def unary!(v) if v then 0 else 1;
+            def unary-(v) 0-v;
+            def binary| 5 (a b) if a then 1 else if b then 1 else 0;
+            def binary& 6 (a b) if !a then 0 else !!b;
+            def binary : 1 (x y) y;
+            !0;
+            -(2+3)*2;
+            1 & 0 | 1;
+            0 | 0 & 1;
+            1 + 2 | 0;
+            putchard(42) : 7;
+        ''')
+        self.assertEqual(results, [1.0, -10.0, 1.0, 0.0, 1.0, 7.0])
+        self.assertEqual(self.evaluator.evaluate('-3 | 0'), 1.0)
+
+    def test_failed_operator(self):
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def binary% 50 (a b) foo(a)')
+        self.assertNotIn('%', self.evaluator.parser.operators_precendence.precedence)
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate_program('def binary% 50 (a b) a; def bar(x) foo(x)')
+        self.assertNotIn('%', self.evaluator.parser.operators_precendence.precedence)
+        self.evaluator.evaluate('def binary& 1 (a b) a * b')
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def binary& 50 (a b) a + b')
+        self.assertEqual(self.evaluator.parser.operators_precendence.precedence['&'], 1)
+
+    def test_comparisons(self):
+        results = self.evaluator.evaluate_program('''
+            def eq(x y) x == y;
+            def ne(x y) x != y;
+            def le(x y) x <= y;
+            def ge(x y) x >= y;
+            eq(1, 1) + ne(1, 1) * 10;
+            le(1, 1) + ge(2, 3) * 10;
+            eq(0/0, 0/0) + ne(0/0, 0/0) * 10 + le(0/0, 1) * 100;
+        ''')
+        self.assertEqual(results, [1.0, 1.0, 110.0])
+
+    def test_logical_operators(self):
+        self.evaluator.evaluate('def between(x a b) if a <= x & x <= b then 1 else 0')
+        self.evaluator.evaluate('def outside(x a b) x < a | x > b')
+        self.assertEqual(self.evaluator.evaluate('between(2, 1, 3) + between(4, 1, 3)'), 1.0)
+        self.assertEqual(self.evaluator.evaluate('outside(2, 1, 3) + outside(4, 1, 3) * 10'), 10.0)
+        self.assertEqual(self.evaluator.evaluate('(0/0 | 0) + (2 & 3) * 10'), 10.0)
+
+    def test_boolean_conditions(self):
+        generator = LLVMGenerator()
+        generator.generate_llvm(Parser().parse('def f(x y) if x < y & y < 10 then for i = 0, i < y in x else 2'))
+        ir = str(generator.module)
+        self.assertNotIn('uitofp', ir)
+        self.assertIn('logicrhs', ir)
+
+    def test_mutable_variables(self):
+        results = self.evaluator.evaluate_program('''
+            def sum(n) var acc in (for i = 1, i < n in acc = acc + i) + acc;
+            def twice(x) (x = x * 2) + x;
+            sum(100);
+            twice(3);
+            var a = 1 in (var a = a + 1 in a) * 10 + a;
+        ''')
+        self.assertEqual(results, [5050.0, 12.0, 21.0])
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def f(x) 1 = x')
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def g(x) y = x')
+
+    def test_variables_promoted(self):
+        generator = LLVMGenerator()
+        generator.generate_llvm(Parser().parse('def f(x) var y = x in for i = 0, i < 10 in y = y * i'))
+        module = llvm.parse_assembly(str(generator.module))
+        self.assertIn('alloca', str(module))
+        self.evaluator.optimizer.run(module)
+        self.assertNotIn('alloca', str(module))
+
+    def test_tail_calls(self):
+        generator = LLVMGenerator()
+        generator.generate_llvm(Parser().parse('def count(n acc) if n < 1 then acc else count(n - 1, acc + 1)'))
+        self.assertIn('musttail call', str(generator.module))
+        # a million frames would overflow the stack without the tail call, even unoptimized
+        self.evaluator.evaluate('def count(n acc) if n < 1 then acc else count(n - 1, acc + 1)', optimize=False)
+        self.assertEqual(self.evaluator.evaluate('count(1000000, 0)', optimize=False), 1000000.0)
+
+    def test_memo(self):
+        results = self.evaluator.evaluate_program('''
+            def memo fib(x) if x < 3 then 1 else fib(x - 1) + fib(x - 2);
+            def memo pair(a b) a * 1000 + b;
+            fib(90);
+            pair(1, 2) + pair(1, 2) + pair(2, 1);
+            pair(0, 0) + pair(0, 0);
+        ''')
+        self.assertEqual(results, [2880067194370816000.0, 4005.0, 0.0])
+        self.evaluator.evaluate('def memo twice(x) pair(x, x) + fib(x)')
+        self.assertEqual(self.evaluator.evaluate('twice(3)'), 3005.0)
+        # the side effect would be lost for cached arguments
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def memo loud(x) putchard(x)')
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('loud(65)')
+
+    def test_math_intrinsics(self):
+        for extern in ('extern sqrt(x)', 'extern pow(x y)', 'extern fma(x y z)', 'extern log(x y)'):
+            self.evaluator.evaluate(extern)
+        self.assertEqual(self.evaluator.generator.functions['sqrt'].name, 'llvm.sqrt.f64')
+        self.assertEqual(self.evaluator.generator.functions['fma'].name, 'llvm.fma.f64')
+        # a different arguments count is left to the C library
+        self.assertEqual(self.evaluator.generator.functions['log'].name, 'log')
+        self.assertEqual(self.evaluator.evaluate('sqrt(16) + pow(2, 10) + fma(2, 3, 4)'), 1038.0)
+        self.evaluator.evaluate('def root(x) sqrt(x)')
+        self.assertEqual(self.evaluator.evaluate('root(2) * root(2)'), 2.0000000000000004)
+        with self.assertRaises(LLVMError):
+            self.evaluator.evaluate('def sqrt(x) x')
@@ -1,7 +1,7 @@
 import unittest
 import pprint
 
-from kaleidoscope_lexer import Lexer
+from kaleidoscope_lexer import Lexer, OpenParenthesisToken
 from tests.settings import TESTFILE
 
 
@@ -14,3 +14,23 @@ class TestLexer(unittest.TestCase):
         tokens = list(self.lexer.tokenize(self.buffer))
         pprint.pprint(tokens)
         self.assertEqual(len(tokens), 34)
+
+    def test_keywords_and_comments(self):
+        tokens = list(Lexer().tokenize('def fib(x) # comment\n  if x < 3.5e2 then 1 else .5'))
+        self.assertEqual([str(token) for token in tokens],
+                         ['DefToken', 'IdentifierToken name=fib', 'OpenParenthesisToken char=(',
+                          'IdentifierToken name=x', 'ClosedParenthesisToken char=)', 'IfToken',
+                          'IdentifierToken name=x', 'CharacterToken char=<', 'NumberToken value=350.0',
+                          'ThenToken', 'NumberToken value=1.0', 'ElseToken', 'NumberToken value=0.5',
+                          'EOFToken'])
+
+    def test_shared_tokens(self):
+        tokens = list(Lexer().tokenize('foo(x, y) (foo)'))
+        self.assertIs(tokens[0], tokens[7])
+        self.assertIs(tokens[1], tokens[6])
+        self.assertIsInstance(tokens[1], OpenParenthesisToken)
+        self.assertFalse(hasattr(tokens[0], '__dict__'))
+
+    def test_comparison_operators(self):
+        tokens = list(Lexer().tokenize('a<=b>=c==d!=e<f=g'))
+        self.assertEqual([token.char for token in tokens[1:-1:2]], ['<=', '>=', '==', '!=', '<', '='])
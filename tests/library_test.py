@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_library import Library
+
+PROGRAM = '''
+    extern floor(x);
+    def adder(x y) x+y;
+    def fib(x) if x < 3 then 1 else fib(x-1) + fib(x-2);
+    def rounded(x) floor(x + 0.5);
+'''
+
+
+class TestLibrary(unittest.TestCase):
+    def setUp(self):
+        self.evaluator = Evaluator()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_emit_formats(self):
+        llvm_mod = self.evaluator.compile_program(PROGRAM)
+        for extension in ('.ll', '.bc', '.s', '.o'):
+            path = os.path.join(self.directory, 'program' + extension)
+            self.evaluator.emit(llvm_mod, path)
+            self.assertGreater(os.path.getsize(path), 0)
+        with open(os.path.join(self.directory, 'program.ll')) as f:
+            self.assertIn('@fib(double', f.read())
+        with self.assertRaises(ValueError):
+            self.evaluator.emit(llvm_mod, os.path.join(self.directory, 'program.exe'))
+
+    @unittest.skipUnless(shutil.which(os.environ.get('CC', 'cc')), 'no C compiler to link shared libraries')
+    def test_shared_library(self):
+        path = os.path.join(self.directory, 'program.so')
+        self.evaluator.emit(self.evaluator.compile_program(PROGRAM), path)
+
+        library = Library(path)
+        self.assertEqual(library.get_function('adder', 2)(5, 4), 9.0)
+        self.assertEqual(library.get_function('fib', 1)(20), 6765.0)
+        self.assertEqual(library.get_function('rounded', 1)(2.6), 3.0)
+        self.assertIs(library.get_function('fib', 1), library.get_function('fib', 1))
+
+    def test_session_untouched(self):
+        self.evaluator.compile_program(PROGRAM + 'def binary% 40 (a b) a - b; def binary| 50 (a b) a + b;')
+        self.evaluator.evaluate('def adder(x y) x*y')
+        self.assertEqual(self.evaluator.evaluate('adder(5, 4)'), 20.0)
+        precedence = self.evaluator.parser.operators_precendence.precedence
+        self.assertNotIn('%', precedence)
+        self.assertEqual(precedence['|'], 5)
@@ -0,0 +1,41 @@
+import unittest
+
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_optimizer import Optimizer
+
+PROGRAM = '''
+    def adder(x y) x+y;
+    def quadruple(x) adder(x, x) + adder(x, x);
+'''
+
+
+class TestOptimizer(unittest.TestCase):
+    def test_levels(self):
+        for optimizer in (Optimizer(opt_level=0, inlining_threshold=None), Optimizer(),
+                          Optimizer(opt_level=3, size_level=1, loop_vectorize=True, slp_vectorize=True)):
+            evaluator = Evaluator(optimizer=optimizer)
+            evaluator.evaluate('def adder(x y) x+y')
+            self.assertEqual(evaluator.evaluate('adder(1, 2) * 2'), 6.0)
+
+    def test_inlining(self):
+        evaluator = Evaluator()
+        llvm_mod = evaluator.compile_program(PROGRAM)
+        self.assertNotIn('call', str(llvm_mod.get_function('quadruple')))
+
+        evaluator = Evaluator(optimizer=Optimizer(inlining_threshold=None))
+        llvm_mod = evaluator.compile_program(PROGRAM)
+        self.assertIn('call', str(llvm_mod.get_function('quadruple')))
+
+    def test_custom_passes(self):
+        optimizer = Optimizer(opt_level=0, inlining_threshold=None, passes=['instruction_combining', 'gvn'])
+        evaluator = Evaluator(optimizer=optimizer)
+        self.assertEqual(evaluator.evaluate('1 + 2 * 3'), 7.0)
+        with self.assertRaises(ValueError):
+            Optimizer(passes=['no_such'])
+
+    def test_reused_pass_manager(self):
+        evaluator = Evaluator()
+        module_pass_manager = evaluator.optimizer.module_pass_manager
+        evaluator.evaluate('def adder(x y) x+y')
+        self.assertEqual(evaluator.evaluate('adder(1, 2)'), 3.0)
+        self.assertIs(evaluator.optimizer.module_pass_manager, module_pass_manager)
@@ -1,7 +1,7 @@
 import unittest
 
 from AST import FunctionNode, BinaryOperatorExpression, NumberExpression, PrototypeNode
-from kaleidoscope_parser import Parser
+from kaleidoscope_parser import Parser, ParserException
 
 
 class TestParser(unittest.TestCase):
@@ -20,7 +20,7 @@ class TestParser(unittest.TestCase):
         self.assertIsInstance(ast, FunctionNode)
         self.assertIsInstance(ast.body, BinaryOperatorExpression)
         self.assertEqual(self.parser._flatten(ast),
-                         ['Function', ['Prototype', 'anonymous_2', ''],
+                         ['Function', ['Prototype', ast.prototype.name, ''],
                           ['Binop', '+', ['Variable', 'x'],
                            ['Binop', '*', ['Variable', 'y'], ['Variable', 'z']]]])
         print(self.parser._flatten(ast))
@@ -40,3 +40,116 @@ class TestParser(unittest.TestCase):
         self.assertIsInstance(ast, PrototypeNode)
         self.assertEqual(len(ast.arguments), 1)
         print(self.parser._flatten(ast))
+
+    def test_program(self):
+        self.parser = Parser()
+        program = self.parser.parse_program("""
+            extern sin(arg);
+            def foo(x y) x + foo(y, 4.0);
+            foo(1, 2)
+            def bar() 25;;
+        """)
+        items = list(program)
+        self.assertEqual(len(items), 4)
+        self.assertIsInstance(items[0], PrototypeNode)
+        self.assertEqual(items[1].prototype.name, 'foo')
+        self.assertTrue(items[2].is_anonymous())
+        self.assertEqual(items[3].prototype.name, 'bar')
+
+    def test_program_error_location(self):
+        self.parser = Parser()
+        program = self.parser.parse_program("def foo(x) x;\ndef bar(x y) (x + y;")
+        self.assertEqual(next(program).prototype.name, 'foo')
+        with self.assertRaises(ParserException) as context:
+            next(program)
+        self.assertEqual((context.exception.line, context.exception.column), (2, 20))
+
+    def test_deep_expressions(self):
+        self.parser = Parser()
+        ast = self.parser.parse("x" + " + x * 2" * 50000)
+        self.assertEqual(ast.body.operator, '+')
+        self.assertEqual(ast.body.right.operator, '*')
+        self.assertEqual(len(self.parser._flatten(ast)), 3)
+
+        ast = self.parser.parse("(" * 20000 + "1" + " + 1)" * 20000)
+        self.assertEqual(ast.body.operator, '+')
+
+    def test_precedence(self):
+        self.parser = Parser()
+        ast = self.parser.parse("a - b - c * d * (e + f) < g")
+        self.assertEqual(self.parser._flatten(ast.body),
+                         ['Binop', '<',
+                          ['Binop', '-',
+                           ['Binop', '-', ['Variable', 'a'], ['Variable', 'b']],
+                           ['Binop', '*',
+                            ['Binop', '*', ['Variable', 'c'], ['Variable', 'd']],
+                            ['Binop', '+', ['Variable', 'e'], ['Variable', 'f']]]],
+                          ['Variable', 'g']])
+        with self.assertRaises(ParserException):
+            self.parser.parse("(a + b")
+
+    def test_compact_nodes(self):
+        self.parser = Parser()
+        ast = self.parser.parse("def foo(x) if x < 1 then foo(x) else for i = 1, i < x in x")
+        for node in (ast, ast.prototype, ast.body, ast.body.condition, ast.body.then_branch, ast.body.else_branch):
+            self.assertFalse(hasattr(node, '__dict__'))
+
+    def test_operators(self):
+        self.parser = Parser()
+        items = list(self.parser.parse_program('''
+            def binary| 5 (a b) if a then 1 else b;
+            def unary-(v) 0 - v;
+            a | -b * c | --(d)
+        '''))
+        self.assertEqual(items[0].prototype.name, 'binary|')
+        self.assertEqual(items[1].prototype.name, 'unary-')
+        self.assertEqual(self.parser._flatten(items[2].body),
+                         ['Binop', '|',
+                          ['Binop', '|', ['Variable', 'a'],
+                           ['Binop', '*', ['Unary', '-', ['Variable', 'b']], ['Variable', 'c']]],
+                          ['Unary', '-', ['Unary', '-', ['Variable', 'd']]]])
+        self.assertEqual(self.parser.operators_precendence.precedence['|'], 5)
+
+        with self.assertRaises(ParserException):
+            self.parser.parse('def binary% 200 (a b) a')
+        with self.assertRaises(ParserException):
+            self.parser.parse('def binary% (a) a')
+        with self.assertRaises(ParserException):
+            self.parser.parse('def unary, (a) a')
+        with self.assertRaises(ParserException):
+            self.parser.parse('def binary+ 50 (a b) a*b')
+        self.assertEqual(self.parser.operators_precendence.precedence['+'], 20)
+        # the operator of a definition which fails to parse is not defined
+        with self.assertRaises(ParserException):
+            self.parser.parse('def binary% 50 (a b) a %')
+        self.assertNotIn('%', self.parser.operators_precendence.precedence)
+
+    def test_var(self):
+        self.parser = Parser()
+        ast = self.parser.parse("var a = 1, b in a = b = a + 1")
+        self.assertEqual(self.parser._flatten(ast.body),
+                         ['Var', [['a', ['Number', 1.0]], ['b', None]],
+                          ['Binop', '=', ['Variable', 'a'],
+                           ['Binop', '=', ['Variable', 'b'],
+                            ['Binop', '+', ['Variable', 'a'], ['Number', 1.0]]]]])
+        with self.assertRaises(ParserException):
+            self.parser.parse("var in 1")
+        with self.assertRaises(ParserException):
+            self.parser.parse("var a = 1 a")
+
+    def test_memo(self):
+        self.parser = Parser()
+        ast = self.parser.parse("def memo fib(x) x")
+        self.assertTrue(ast.memoize)
+        self.assertEqual(self.parser._flatten(ast),
+                         ['Function', ['Prototype', 'fib', 'x'], ['Variable', 'x'], 'memo'])
+        self.assertFalse(self.parser.parse("def fib(x) x").memoize)
+        self.assertTrue(self.parser.parse("def memo binary% 50 (a b) a").memoize)
+        # memo is a name anywhere else
+        ast = self.parser.parse("def memo(memo) memo")
+        self.assertFalse(ast.memoize)
+        self.assertEqual(self.parser._flatten(ast),
+                         ['Function', ['Prototype', 'memo', 'memo'], ['Variable', 'memo']])
+        ast = self.parser.parse("def memo memo(x) var memo = x in memo")
+        self.assertTrue(ast.memoize)
+        self.assertEqual(ast.prototype.name, 'memo')
@@ -0,0 +1,81 @@
+import unittest
+
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_parser import Parser
+from purity import PurityAnalysis
+
+
+class TestPurity(unittest.TestCase):
+    def test_analysis(self):
+        purity = PurityAnalysis()
+        parser = Parser()
+        for ast in parser.parse_program('''
+            extern sin(x);
+            extern putchard(x);
+            def sq(x) x * x;
+            def wave(x) sin(sq(x)) & x;
+            def loud(x) sq(putchard(x));
+            def down(x) if x < 1 then 0 else down(x - 1);
+            def loop(n) for i = 0, i < n in sq(i);
+            def memo cached(x) sq(x);
+            def viacache(x) cached(x);
+            def unary-(x) 0 - x;
+            def negative(x) -sq(x);
+        '''):
+            if ast.kind == 'prototype_node':
+                purity.add_extern(ast)
+            else:
+                purity.add_function(ast)
+        self.assertEqual(purity.attributes('sin'), ('nounwind', 'readnone', 'willreturn'))
+        self.assertEqual(purity.attributes('putchard'), ())
+        self.assertEqual(purity.attributes('sq'), ('nounwind', 'readnone', 'willreturn'))
+        self.assertEqual(purity.attributes('wave'), ('nounwind', 'readnone', 'willreturn'))
+        self.assertEqual(purity.attributes('loud'), ())
+        self.assertEqual(purity.attributes('down'), ('nounwind', 'readnone'))
+        self.assertEqual(purity.attributes('loop'), ('nounwind', 'readnone'))
+        self.assertEqual(purity.attributes('cached'), ())
+        self.assertEqual(purity.attributes('viacache'), ())
+        self.assertEqual(purity.attributes('negative'), ('nounwind', 'readnone', 'willreturn'))
+        self.assertEqual(purity.attributes('unknown'), ())
+
+    def test_optimizations(self):
+        evaluator = Evaluator()
+        evaluator.evaluate('extern sin(x)')
+        evaluator.evaluate('def sq(x) x * x')
+
+        def optimized(string):
+            generator = evaluator.generator
+            generator.new_module()
+            function = generator.generate_llvm(Parser().parse(string))
+            return str(evaluator._optimize(generator.module, True).get_function(function.name))
+
+        self.assertEqual(optimized('def twice(x) sq(x) + sin(x) + sq(x) + sin(x)').count('call '), 2)
+        self.assertEqual(optimized('def unused(x) var y = sq(x) + sin(x) in x').count('call '), 0)
+        self.assertEqual(optimized('def used(x) var y = putchard(x) in x').count('call '), 1)
+        hoisted = optimized('def hoisted(x n) var a in (for i = 1, i < n in a = a + sq(x)) + a')
+        self.assertNotIn('call ', hoisted[hoisted.index('loop:'):])
+
+    def test_replaced_extern(self):
+        evaluator = Evaluator()
+        evaluator.evaluate('extern hypot(x y)')
+        evaluator.evaluate('def g(x y) hypot(x, y)')
+        evaluator.evaluate('def hypot(x y) g(x, y)')
+        purity = evaluator.generator.purity
+        self.assertEqual(purity.attributes('hypot'), ())
+        self.assertEqual(evaluator.generator.functions['hypot'].attributes, set())
+        evaluator.evaluate('def h(x) hypot(x, x)')
+        self.assertEqual(purity.attributes('h'), ())
+
+    def test_anonymous(self):
+        evaluator = Evaluator()
+        evaluator.evaluate('def sq(x) x * x')
+        size = len(evaluator.generator.purity.pure)
+        for i in range(20):
+            evaluator.evaluate('sq({0})'.format(i))
+        evaluator.evaluate_program('sq(1); sq(2);')
+        self.assertEqual(len(evaluator.generator.purity.pure), size)
+        self.assertEqual(len(evaluator.generator.purity.returns), size)
+
+
+if __name__ == '__main__':
+    unittest.main()
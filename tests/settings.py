@@ -1 +1,3 @@
-TESTFILE = 'testfile.ko'
+import os
+
+TESTFILE = os.path.join(os.path.dirname(__file__), 'testfile.ko')
@@ -0,0 +1,53 @@
+import json
+import unittest
+
+from kaleidoscope_evaluator import Evaluator
+from kaleidoscope_stats import Stats
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        stats = Stats(trace=True)
+        with stats.phase('parse'):
+            stats.count('tokens', 3)
+        with stats.phase('parse'):
+            stats.count('tokens')
+        data = json.loads(stats.to_json())
+        self.assertEqual(data['phases']['parse']['calls'], 2)
+        self.assertEqual(data['counters'], {'tokens': 4})
+        events = json.loads(stats.to_chrome_trace())['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['parse', 'parse'])
+        self.assertEqual(events[0]['ph'], 'X')
+
+        stats.reset()
+        self.assertEqual(stats.as_dict(), {'phases': {}, 'counters': {}})
+
+    def test_evaluator_stats(self):
+        stats = Stats()
+        evaluator = Evaluator(stats=stats)
+        stats.reset()
+        evaluator.evaluate('def sq(x) x * x + 0 * x')
+        self.assertEqual(evaluator.evaluate('sq(3)'), 9.0)
+        self.assertEqual(set(stats.times), {'lex', 'parse', 'simplify', 'codegen', 'parse_assembly', 'optimize',
+                                            'finalize', 'execute'})
+        self.assertEqual(stats.counters['tokens'], 13 + 5)
+        self.assertGreater(stats.counters['instructions_before'], stats.counters['instructions_after'])
+        self.assertGreater(stats.counters['object_bytes'], 0)
+
+    def test_profile(self):
+        evaluator = Evaluator(profile=True)
+        evaluator.evaluate_program('''
+            def fib(x) if x < 3 then 1 else fib(x - 1) + fib(x - 2);
+            def memo cached(x) x;
+            fib(10);
+            cached(1) + cached(1);
+        ''')
+        profile = evaluator.profile()
+        self.assertEqual(profile['fib']['calls'], 109)
+        self.assertGreater(profile['fib']['cycles'], 0)
+        self.assertEqual(profile['cached']['calls'], 2)
+        self.assertNotIn('putchard', profile)
+
+
+if __name__ == '__main__':
+    unittest.main()